@@ -1,7 +1,10 @@
 
 __author__ = 'Teodor Yantcheff'
 
+from itertools import islice
+
 from .utils import *
+from .utils import _json_dumps
 
 from ospy import version
 from ospy.stations import stations
@@ -82,11 +85,13 @@ class Stations(object):
         update = json.loads(web.data())
         if station_id:
             station_id = int(station_id)
-            self._dict_to_station(station_id, update)
+            with stations.edit():
+                self._dict_to_station(station_id, update)
             return self._station_to_dict(stations[station_id])
         else:
-            for sid, upd in enumerate(update):
-                self._dict_to_station(sid, upd)
+            with stations.edit():
+                for sid, upd in enumerate(update):
+                    self._dict_to_station(sid, upd)
             return [self._station_to_dict(s) for s in stations]
 
     @auth
@@ -157,6 +162,7 @@ class Programs(object):
             'type_name', 'summary', 'schedule'
         ]
 
+    @helpers.versioned_response()
     @does_json
     def GET(self, program_id):
         logger.debug('GET /programs/{}'.format(program_id if program_id else ''))
@@ -251,6 +257,7 @@ class Options(object):
             for i, key in enumerate(options.get_options()) if key not in self.EXCLUDED_OPTIONS
         }
 
+    @helpers.versioned_response()
     @does_json
     def GET(self):
         logger.debug('GET ' + self.__class__.__name__)
@@ -289,22 +296,58 @@ class Options(object):
 
 class Logs(object):
 
-    def _runlog_to_dict(self, log_entry):
+    def _runlog_to_dict(self, log_entry, station_names):
         return {
+            'cursor': log.run_cursor(log_entry),
             'start': log_entry['start'],
             'end': log_entry['end'],
             'duration': str(log_entry['end'] - log_entry['start']).split('.')[0],  # pass it as a baked string to the client
             'manual': log_entry['manual'],
             'station': log_entry['station'],
-            'station_name': stations[log_entry['station']].name,
+            'station_name': station_names.get(log_entry['station'], ''),
             'program_id': log_entry['program'],
             'program_name': log_entry['program_name'],
         }
 
-    @does_json
+    def _finished_runs(self):
+        """Returns the finished runs selected by the start, end, station and after parameters."""
+        try:
+            runs = log.iter_runs(**helpers.run_filters(web.input()))
+        except ValueError as e:
+            raise badrequest('{"error": "(ValueError) Inappropriate argument value - ' + str(e) + '"}')
+        return (run for run in runs if not run['active'])
+
     def GET(self):
         logger.debug('GET logs ' + self.__class__.__name__)
-        return [self._runlog_to_dict(fr) for fr in log.finished_runs()]
+        if web.input().get('format', '') == 'jsonl':
+            return self._export()
+        return self._list()
+
+    @helpers.versioned_response()
+    @does_json
+    def _list(self):
+        """Returns the runs as a list, at most limit runs if given.
+        The cursor to request the next runs is given in the X-Next-Cursor header."""
+        try:
+            limit = int(web.input().get('limit', 0))
+        except ValueError as e:
+            raise badrequest('{"error": "(ValueError) Inappropriate argument value - ' + str(e) + '"}')
+        station_names = {station.index: station.name for station in stations.get()}
+        runs = self._finished_runs()
+        if limit > 0:
+            runs = list(islice(runs, limit + 1))
+            if len(runs) > limit:
+                runs = runs[:limit]
+                web.header('X-Next-Cursor', log.run_cursor(runs[-1]))
+        return [self._runlog_to_dict(fr, station_names) for fr in runs]
+
+    def _export(self):
+        """Streams the runs as JSON lines."""
+        web.header('Content-Type', 'application/x-ndjson')
+        web.header('Access-Control-Allow-Origin', '*')
+        station_names = {station.index: station.name for station in stations.get()}
+        runs = self._finished_runs()
+        return (_json_dumps(self._runlog_to_dict(fr, station_names)) + '\n' for fr in runs)
         # web.header('Cache-Control', 'no-cache')
         # web.header('Content-Type', 'application/json')
         # web.header('Access-Control-Allow-Origin', '*')
@@ -81,16 +81,16 @@ def does_json(func):
 
         except IndexError as e:  # No such item
             logger.exception('IndexError')
-            raise badrequest('{"error": "(IndexError) Index out of bounds - ' + e.message + '"}')
+            raise badrequest('{"error": "(IndexError) Index out of bounds - ' + str(e) + '"}')
 
         except ValueError as e:  # json errors
             logger.exception('ValueError JSON')
-            raise badrequest('{"error": "(ValueError) Inappropriate argument value - ' + e.message + '"}')
+            raise badrequest('{"error": "(ValueError) Inappropriate argument value - ' + str(e) + '"}')
             # raise badrequest(format(e.message))
 
         except KeyError as e:  # missing attribute names
             logger.exception('KeyError')
-            raise badrequest('{"error": "(KeyError) Missing key - ' + e.message + '"}')
+            raise badrequest('{"error": "(KeyError) Missing key - ' + str(e) + '"}')
             # raise badrequest(format(e.message))
 
     return wrapper
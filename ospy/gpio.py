@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Rimco'
+
+# System imports
+from collections import deque
+import threading
+import time
+
+
+def rpi():
+    """Returns the GPIO module of a Raspberry Pi, using header connector pin numbers."""
+    import RPi.GPIO as GPIO  # RPi hardware
+    GPIO.setwarnings(False)
+    GPIO.setmode(GPIO.BOARD)  # Pin numbers are always the same regardless of Raspberry Pi board revision.
+    return GPIO
+
+
+def bbb():
+    """Returns the GPIO module of a Beagle Bone Black."""
+    import Adafruit_BBIO.GPIO as GPIO  # Beagle Bone Black hardware
+    GPIO.setwarnings(False)
+    return GPIO
+
+
+class _SimulatedShiftRegister(object):
+    """Follows the pins of a (chain of) 74HC595 shift register(s) connected to a simulated GPIO."""
+
+    def __init__(self, dat, clk, lat, size):
+        self._dat = dat
+        self._clk = clk
+        self._lat = lat
+        self._shifted = deque([False] * size, size)
+        self.outputs = [False] * size  # The latched outputs, in the same order as the stations
+
+    def changed(self, gpio, pin, old, new):
+        if new and not old:
+            if pin == self._clk:
+                self._shifted.appendleft(bool(gpio.levels.get(self._dat, gpio.LOW)))
+            elif pin == self._lat:
+                self.outputs = list(self._shifted)
+
+
+class SimulatedGPIO(object):
+    """Stand-in for RPi.GPIO that only records what happens, usable without any hardware.
+    Every call is counted as taking `latency` seconds, which allows estimating how long updating
+    the outputs would take on real hardware (and comparing drivers) on any machine."""
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self, latency=0.000005):
+        self.latency = latency
+        self.mode = None
+        self.directions = {}
+        self.levels = {}
+        self._lock = threading.Lock()
+        self._registers = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Resets the number of calls, the toggles per pin and the (simulated) busy time."""
+        self.calls = 0
+        self.toggles = {}
+        self.busy_time = 0.0
+        self.wall_time = 0.0  # Time actually spent in this simulator
+
+    def shift_register(self, dat, clk, lat, size=1024):
+        """Returns a simulated shift register listening to the given pins."""
+        register = _SimulatedShiftRegister(dat, clk, lat, size)
+        self._registers.append(register)
+        return register
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        with self._lock:
+            self.calls += 1
+            self.busy_time += self.latency
+            self.directions[pin] = direction
+            if initial is not None:
+                self.levels[pin] = initial
+
+    def output(self, pin, value):
+        start = time.time()
+        with self._lock:
+            self.calls += 1
+            self.busy_time += self.latency
+            old = self.levels.get(pin, self.LOW)
+            self.levels[pin] = value
+            if bool(old) != bool(value):
+                self.toggles[pin] = self.toggles.get(pin, 0) + 1
+                for register in self._registers:
+                    register.changed(self, pin, old, value)
+            self.wall_time += time.time() - start
+
+    def input(self, pin):
+        with self._lock:
+            self.calls += 1
+            self.busy_time += self.latency
+            return self.levels.get(pin, self.LOW)
+
+    def cleanup(self):
+        with self._lock:
+            self.directions.clear()
+
+
+_simulator = None
+
+
+def simulated():
+    """Returns the simulated GPIO that is shared by the stations, inputs and outputs."""
+    global _simulator
+    if _simulator is None:
+        _simulator = SimulatedGPIO()
+    return _simulator
@@ -9,6 +9,8 @@ import logging
 import random
 import time
 import errno
+from collections import OrderedDict
+from functools import wraps
 from threading import Lock
 
 BRUTEFORCE_LOCK = Lock()
@@ -414,6 +416,71 @@ def check_login(redirect=False):
     return False
 
 
+_versioned_responses = OrderedDict()
+_versioned_responses_epoch = '%x' % int(time.time())  # The versions start again after restarting
+_versioned_responses_lock = Lock()
+VERSIONED_RESPONSES = 64  # Number of responses kept by versioned_response
+
+
+def versioned_response(max_age=None):
+    """Decorator for GET methods whose response only depends on the request and the status version.
+    The response is sent with an ETag based on the version, a request that already has this version
+    gets a 304 (Not Modified) response. Otherwise the response (including its headers) is reused as long
+    as the version is the same. If the response also changes with time, max_age limits the number of
+    seconds the same ETag is used."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            import web
+            from ospy.options import status_version
+            version = status_version.value
+            etag = '%s-%d' % (_versioned_responses_epoch, version)
+            if max_age is not None:
+                etag += '-%d' % (time.time() // max_age)
+            etag = '"%s"' % etag
+
+            web.header('ETag', etag)
+            if etag in [tag.strip() for tag in web.ctx.env.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+                raise web.notmodified()
+
+            key = (func.__module__, func.__name__, web.ctx.homepath + web.ctx.fullpath)
+            with _versioned_responses_lock:
+                cached = _versioned_responses.get(key)
+            if cached is not None and cached[0] == etag:
+                for name, value in cached[1]:
+                    web.header(name, value)
+                return cached[2]
+
+            headers_before = len(web.ctx.headers)
+            result = func(*args, **kwargs)
+            headers = [header for header in web.ctx.headers[headers_before:] if header[0] != 'ETag']
+            with _versioned_responses_lock:
+                _versioned_responses.pop(key, None)
+                _versioned_responses[key] = (etag, headers, result)
+                while len(_versioned_responses) > VERSIONED_RESPONSES:
+                    _versioned_responses.popitem(last=False)
+            return result
+        return wrapper
+    return decorator
+
+
+def run_filters(qdict):
+    """Returns the arguments for log.iter_runs given in the request: the first and last date (YYYY-MM-DD),
+    the station index and the cursor of the run to continue after."""
+    result = {}
+    if qdict.get('start'):
+        result['start'] = datetime.datetime.combine(
+            datetime.datetime.strptime(qdict['start'], '%Y-%m-%d').date(), datetime.time.min)
+    if qdict.get('end'):
+        result['end'] = datetime.datetime.combine(
+            datetime.datetime.strptime(qdict['end'], '%Y-%m-%d').date(), datetime.time.max)
+    if qdict.get('station'):
+        result['station'] = int(qdict['station'])
+    if qdict.get('after'):
+        result['after'] = qdict['after']
+    return result
+
+
 def get_input(qdict, key, default=None, cast=None):
     result = default
     if key in qdict:
@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Rimco'
 
+from ospy import gpio
+from ospy.options import options
+
 
 class _RainSensorMixIn(object):
     def rain_sensed(self):
@@ -33,12 +36,8 @@ class _IOInputs(_RainSensorMixIn):
 
 class _RPiInputs(_IOInputs, _RainSensorMixIn):
     def __init__(self):
-        import RPi.GPIO as GPIO  # RPi hardware
-
         super(_RPiInputs, self).__init__()
-        self._io = GPIO
-        self._io.setwarnings(False)
-        self._io.setmode(self._io.BOARD)
+        self._io = gpio.rpi()
 
         self._mapping = {
             'rain_input': 8
@@ -47,21 +46,31 @@ class _RPiInputs(_IOInputs, _RainSensorMixIn):
 
 class _BBBInputs(_IOInputs, _RainSensorMixIn):
     def __init__(self):
-        import Adafruit_BBIO.GPIO as GPIO  # Beagle Bone Black hardware
-
         super(_BBBInputs, self).__init__()
-        self._io = GPIO
-        self._io.setwarnings(False)
+        self._io = gpio.bbb()
 
         self._mapping = {
             'rain_input': "P9_15"
         }
 
 
-try:
-    inputs = _RPiInputs()
-except Exception:
+class _SimulatedInputs(_IOInputs, _RainSensorMixIn):
+    def __init__(self):
+        super(_SimulatedInputs, self).__init__()
+        self._io = gpio.simulated()
+
+        self._mapping = {
+            'rain_input': 8
+        }
+
+
+if options.gpio_backend == 'simulated':
+    inputs = _SimulatedInputs()
+else:
     try:
-        inputs = _BBBInputs()
+        inputs = _RPiInputs()
     except Exception:
-        inputs = _DummyInputs()
\ No newline at end of file
+        try:
+            inputs = _BBBInputs()
+        except Exception:
+            inputs = _DummyInputs()
\ No newline at end of file
@@ -5,8 +5,13 @@ from __future__ import print_function
 __author__ = 'Rimco'
 
 # System imports
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 import datetime
+import json
 import logging
+import os
+import re
 import traceback
 from os import path
 import threading
@@ -14,23 +19,286 @@ import time
 import sys
 
 # Local imports
-from ospy.options import options
+from ospy import helpers
+from ospy.options import options, state_version
 
 EVENT_FILE = './ospy/data/events.log'
+RUN_JOURNAL_DIR = './ospy/data/runs'
 EVENT_FORMAT = "%(asctime)s [%(levelname)s %(event_type)s] %(filename)s:%(lineno)d: %(message)s"
 RUN_START_FORMAT = "%(asctime)s [START  Run] Program %(program)d - Station %(station)d: From %(start)s to %(end)s"
 RUN_FINISH_FORMAT = "%(asctime)s [FINISH Run] Program %(program)d - Station %(station)d: From %(start)s to %(end)s"
 
 
+class RunInterval(object):
+    """A single run of a station stored in the run log.
+    The fields are stored in slots to keep (long) run logs compact, but it can be used like a dict.
+    It is not a dict though, so active_runs, finished_runs and iter_runs return plain dict copies."""
+    __slots__ = ('station', 'active', 'program', 'program_name', 'fixed', 'cut_off', 'manual', 'blocked',
+                 'start', 'original_start', 'end', 'uid', 'usage', 'adjustment', '_extra')
+    FIELDS = __slots__[:-1]
+    _FIELD_SET = frozenset(FIELDS)
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None  # Any keys that are not one of the fields (set by plugins for example)
+        for other in args + (kwargs,):
+            for key in other.keys():
+                self[key] = other[key]
+
+    def __getitem__(self, key):
+        try:
+            if key in self._FIELD_SET:
+                return getattr(self, key)
+            return self._extra[key]
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        try:
+            if key in self._FIELD_SET:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self._FIELD_SET:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return hasattr(other, 'keys') and self.to_dict() == dict((key, other[key]) for key in other.keys())
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'RunInterval(%r)' % self.to_dict()
+
+    def __reduce__(self):
+        # Store as a plain dict, this keeps the stored run log readable without this class
+        return dict, (self.items(),)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs,):
+            for key in other.keys():
+                self[key] = other[key]
+
+    def copy(self):
+        result = RunInterval()
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                setattr(result, key, getattr(self, key))
+        if self._extra is not None:
+            result._extra = self._extra.copy()
+        return result
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class _RunJournal(object):
+    """Append-only storage of the run log.
+    Each change is appended as a JSON line to the last segment file, a new segment is started once it
+    has grown too large. Compaction replaces all segments by a single one containing the current runs."""
+    SEGMENT_SIZE = 256*1024
+    SEGMENT_NAME = re.compile(r'^runs-(\d+)\.jsonl$')
+    DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+    DATE_FORMAT = '%Y-%m-%d'
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._file = None
+        self._cut_off = None  # The segment ending with an interrupted write, which should not be appended to
+        self.records = 0  # The number of records in all segments
+
+    def _segments(self):
+        """Returns the numbers of all segments in order."""
+        if not path.isdir(self._directory):
+            return []
+        return sorted(int(match.group(1)) for match in
+                      (self.SEGMENT_NAME.match(name) for name in os.listdir(self._directory)) if match)
+
+    def _segment_path(self, number):
+        return path.join(self._directory, 'runs-%06d.jsonl' % number)
+
+    @staticmethod
+    def _key(run):
+        return '%s@%s' % (run['data']['uid'], run['data']['start'].isoformat())
+
+    @classmethod
+    def _encode(cls, obj):
+        """Encodes the values JSON does not support. Tuples are stored as lists by JSON itself."""
+        if isinstance(obj, RunInterval):
+            return obj.to_dict()
+        elif isinstance(obj, datetime.datetime):
+            return {'__datetime__': obj.strftime(cls.DATETIME_FORMAT)}
+        elif isinstance(obj, datetime.date):
+            return {'__date__': obj.strftime(cls.DATE_FORMAT)}
+        elif isinstance(obj, (set, frozenset)):
+            return {'__set__': list(obj)}
+        # Unknown values (set by plugins for example) should not prevent storing the run:
+        logging.warning('Storing %r in the run journal as text.', obj)
+        return repr(obj)
+
+    @classmethod
+    def _decode(cls, obj):
+        if '__datetime__' in obj:
+            return datetime.datetime.strptime(obj['__datetime__'], cls.DATETIME_FORMAT)
+        elif '__date__' in obj:
+            return datetime.datetime.strptime(obj['__date__'], cls.DATE_FORMAT).date()
+        elif '__set__' in obj:
+            return set(obj['__set__'])
+        return obj
+
+    def _dump(self, record):
+        return json.dumps(record, default=self._encode) + '\n'
+
+    def replay(self):
+        """Returns all runs stored in the journal."""
+        runs = OrderedDict()
+        self.records = 0
+        self._cut_off = None
+        for number in self._segments():
+            with open(self._segment_path(number)) as fh:
+                for line in fh:
+                    if not line.endswith('\n'):
+                        self._cut_off = number  # Appending would join the next record to this line
+                    try:
+                        record = json.loads(line, object_hook=self._decode)
+                    except ValueError:
+                        continue  # Interrupted write
+                    self.records += 1
+                    if 'run' in record:
+                        runs[record['key']] = record['run']
+                    else:
+                        runs.pop(record['key'], None)
+        return list(runs.values())
+
+    def append(self, changed=(), removed=()):
+        """Stores the (new) state of the changed runs and the removal of the removed runs."""
+        data = ''.join([self._dump({'key': self._key(run), 'run': run}) for run in changed] +
+                       [self._dump({'key': self._key(run)}) for run in removed])
+        if not data:
+            return
+
+        if self._file is not None and os.fstat(self._file.fileno()).st_size >= self.SEGMENT_SIZE:
+            self.close()
+        if self._file is None:
+            segments = self._segments()
+            number = segments[-1] if segments else 1
+            if path.isfile(self._segment_path(number)) and \
+                    (path.getsize(self._segment_path(number)) >= self.SEGMENT_SIZE or number == self._cut_off):
+                number += 1
+            helpers.mkdir_p(self._directory)
+            self._file = open(self._segment_path(number), 'a')
+
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except (IOError, OSError):
+            # The segment might end with a partial record now, which should not be continued:
+            self._cut_off = self._segments()[-1]
+            try:
+                self.close()
+            except (IOError, OSError):
+                self._file = None
+            raise
+        self.records += len(changed) + len(removed)
+
+    def compact(self, runs):
+        """Replaces all segments by a single segment containing only the given runs."""
+        self.close()
+        segments = self._segments()
+        if runs:
+            helpers.mkdir_p(self._directory)
+            segment_path = self._segment_path(segments[-1] + 1 if segments else 1)
+            with open(segment_path + '.tmp', 'w') as fh:
+                fh.write(''.join(self._dump({'key': self._key(run), 'run': run}) for run in runs))
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.rename(segment_path + '.tmp', segment_path)
+
+        # Replaying the old segments before the new one would result in the same runs, so this is safe:
+        for number in segments:
+            os.remove(self._segment_path(number))
+        self.records = len(runs)
+
+    def empty(self):
+        return self.records == 0 and not self._segments()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
 class _Log(logging.Handler):
+    COMPACT_RECORDS = 1000  # Minimum number of records in the run journal before compacting it
+
     def __init__(self):
         super(_Log, self).__init__()
+        self._journal = _RunJournal(RUN_JOURNAL_DIR)
+        self._journal_outdated = False
+        runs = self._journal.replay()
+        if 'logged_runs' in options:
+            # UPGRADE: runs used to be stored in the options
+            runs = options.logged_runs
+            self._journal.compact(runs)
+            del options.logged_runs
+
         self._log = {
-            'Run': options.logged_runs[:]
+            'Run': [{'time': run['time'], 'level': run['level'], 'data': RunInterval(run['data'])}
+                    for run in runs]
         }
+        self._log['Run'].sort(key=lambda run: run['data']['start'])
         self._lock = threading.RLock()
         self._plugin_time = time.time() + 3
 
+        self._active = OrderedDict()  # uid -> active runs with this uid
+        self._station_runs = {}       # station -> runs of this station sorted on start
+        self._station_active = {}     # station -> active runs of this station (lists are replaced, not changed)
+        self._run_starts = []         # start of each run in self._log['Run']
+        self._run_max_ends = []       # running maximum of the end of each run in self._log['Run']
+        self._index_runs()
+
     @property
     def level(self):
         return logging.DEBUG if options.debug_log else logging.INFO
@@ -39,12 +307,19 @@ class _Log(logging.Handler):
     def level(self, value):
         pass  # Override level using options
 
-    def _save_logs(self):
+    def _save_logs(self, changed=(), removed=()):
+        """Writes the changed and removed runs to the run journal (if runs should be kept)."""
         from ospy.programs import programs, ProgramType
-        result = []
         if options.run_log or any(program.type == ProgramType.WEEKLY_WEATHER for program in programs.get()):
-            result = self._log['Run']
-        options.logged_runs = result
+            if self._journal_outdated or self._journal.records > max(self.COMPACT_RECORDS, 2*len(self._log['Run'])):
+                self._journal.compact(self._log['Run'])
+                self._journal_outdated = False
+            else:
+                self._journal.append(changed, removed)
+        else:
+            if not self._journal.empty():
+                self._journal.compact([])
+            self._journal_outdated = True  # Write all runs once they should be kept again
 
     @staticmethod
     def _save_log(msg, level, event_type):
@@ -68,7 +343,7 @@ class _Log(logging.Handler):
             return  # We cannot prune
 
         if event_type == 'Run':
-            self.clear_runs(False)
+            self._remove_runs(False)  # The state version is increased by the caller
         else:
             # Delete everything older than 1 day
             current_time = datetime.datetime.now()
@@ -76,27 +351,88 @@ class _Log(logging.Handler):
                     current_time - self._log[event_type][0]['time'] > datetime.timedelta(days=1):
                 del self._log[event_type][0]
 
+    def _index_runs(self):
+        """Rebuilds all indices of the run log."""
+        self._active.clear()
+        self._station_runs.clear()
+        self._station_active.clear()
+        del self._run_starts[:]
+        del self._run_max_ends[:]
+        for run in self._log['Run']:
+            self._index_run(run['data'])
+
+    def _index_run(self, interval):
+        """Adds the interval to the indices, it should be the last run in the run log."""
+        if interval['active']:
+            self._active.setdefault(interval['uid'], []).append(interval)
+            self._station_active[interval['station']] = self._station_active.get(interval['station'], []) + [interval]
+        self._station_runs.setdefault(interval['station'], []).append(interval)
+        self._run_starts.append(interval['start'])
+        self._run_max_ends.append(max(self._run_max_ends[-1], interval['end']) if self._run_max_ends
+                                  else interval['end'])
+
+    def _index_finished(self, interval):
+        """Updates the indices after the interval has been finished."""
+        runs = self._active[interval['uid']]
+        runs[:] = [run for run in runs if run is not interval]
+        if not runs:
+            del self._active[interval['uid']]
+
+        station_active = [run for run in self._station_active.get(interval['station'], []) if run is not interval]
+        if station_active:
+            self._station_active[interval['station']] = station_active
+        else:
+            self._station_active.pop(interval['station'], None)
+
+        # The end time might have moved beyond the running maximum:
+        for index in range(bisect_left(self._run_starts, interval['start']), len(self._run_max_ends)):
+            if self._run_max_ends[index] >= interval['end']:
+                break
+            self._run_max_ends[index] = interval['end']
+
+    def _run_index(self, interval):
+        """Returns the index of the interval in the run log."""
+        index = bisect_left(self._run_starts, interval['start'])
+        while self._log['Run'][index]['data'] is not interval:
+            index += 1
+        return index
+
     def start_run(self, interval):
         """Indicates a certain run has been started. The start time will be updated."""
         with self._lock:
             # Update time with current time
-            interval = interval.copy()
+            interval = RunInterval(interval) if isinstance(interval, dict) else interval.copy()
             interval['start'] = datetime.datetime.now()
             interval['active'] = True
 
-            self._log['Run'].append({
+            entry = {
                 'time': datetime.datetime.now(),
                 'level': logging.INFO,
                 'data': interval
-            })
-
-            fmt_dict = interval.copy()
+            }
+            if self._run_starts and self._run_starts[-1] > interval['start']:
+                # The clock has been changed, keep the log sorted on start:
+                self._log['Run'].insert(bisect_right(self._run_starts, interval['start']), entry)
+                self._index_runs()
+            else:
+                self._log['Run'].append(entry)
+                self._index_run(interval)
+            try:
+                self._save_logs(changed=[entry])
+            except Exception:
+                # Keep the run log equal to the journal:
+                del self._log['Run'][self._run_index(interval)]
+                self._index_runs()
+                raise
+
+            fmt_dict = interval.to_dict()
             fmt_dict['asctime'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
             fmt_dict['start'] = fmt_dict['start'].strftime("%Y-%m-%d %H:%M:%S")
             fmt_dict['end'] = fmt_dict['end'].strftime("%Y-%m-%d %H:%M:%S")
 
             self._save_log(RUN_START_FORMAT % fmt_dict, logging.DEBUG, 'Run')
             self._prune('Run')
+            state_version.bump()
 
     def finish_run(self, interval):
         """Indicates a certain run has been stopped. Use interval=None to stop all active runs.
@@ -104,32 +440,112 @@ class _Log(logging.Handler):
         with self._lock:
             if isinstance(interval, str) or interval is None:
                 uid = interval
-            elif isinstance(interval, dict) and 'uid' in interval:
+            elif isinstance(interval, (dict, RunInterval)) and 'uid' in interval:
                 uid = interval['uid']
             else:
                 raise ValueError
 
-            for entry in self._log['Run']:
-                if (uid is None or entry['data']['uid'] == uid) and entry['data']['active']:
-                    entry['data']['end'] = datetime.datetime.now()
-                    entry['data']['active'] = False
-
-                    fmt_dict = entry['data'].copy()
-                    fmt_dict['asctime'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
-                    fmt_dict['start'] = fmt_dict['start'].strftime("%Y-%m-%d %H:%M:%S")
-                    fmt_dict['end'] = fmt_dict['end'].strftime("%Y-%m-%d %H:%M:%S")
-
-                    self._save_log(RUN_FINISH_FORMAT % fmt_dict, logging.DEBUG, 'Run')
-                    if uid is not None:
-                        break
+            if uid is None:
+                to_finish = self._active_runs()
+            else:
+                to_finish = self._active.get(uid, [])[:1]
+
+            finished = []
+            ends = []
+            for run in to_finish:
+                ends.append(run['end'])
+                run['end'] = datetime.datetime.now()
+                run['active'] = False
+                self._index_finished(run)
+                finished.append(self._log['Run'][self._run_index(run)])
+
+            try:
+                self._save_logs(changed=finished)
+            except Exception:
+                # Keep the run log equal to the journal:
+                for run, end in zip(to_finish, ends):
+                    run['end'] = end
+                    run['active'] = True
+                self._index_runs()
+                raise
+
+            for run in to_finish:
+                fmt_dict = run.to_dict()
+                fmt_dict['asctime'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
+                fmt_dict['start'] = fmt_dict['start'].strftime("%Y-%m-%d %H:%M:%S")
+                fmt_dict['end'] = fmt_dict['end'].strftime("%Y-%m-%d %H:%M:%S")
+
+                self._save_log(RUN_FINISH_FORMAT % fmt_dict, logging.DEBUG, 'Run')
 
             self._prune('Run')
+            state_version.bump()
+
+    def _active_runs(self):
+        return [run for runs in self._active.values() for run in runs]
 
     def active_runs(self):
-        return [run['data'].copy() for run in self._log['Run'] if run['data']['active']]
+        with self._lock:
+            return [run.to_dict() for run in self._active_runs()]
 
     def finished_runs(self):
-        return [run['data'].copy() for run in self._log['Run'] if not run['data']['active']]
+        with self._lock:
+            return [run['data'].to_dict() for run in self._log['Run'] if not run['data']['active']]
+
+    def active_runs_for_station(self, station):
+        """Returns the active runs of the given station as RunIntervals.
+        The runs are not copied, so they should not be modified."""
+        with self._lock:
+            return self._station_active.get(station, [])
+
+    def runs_for_station(self, station):
+        """Returns all runs (active or finished) of the given station as RunIntervals sorted on start.
+        Neither the list nor the runs are copied, so they should not be modified. Runs started later
+        are appended to the list."""
+        with self._lock:
+            return self._station_runs.get(station, [])
+
+    def runs_between(self, start, end):
+        """Returns all runs (active or finished) overlapping the given period as RunIntervals sorted on start.
+        The runs are not copied, so they should not be modified."""
+        with self._lock:
+            first = bisect_left(self._run_max_ends, start)
+            last = bisect_right(self._run_starts, end)
+            return [run['data'] for run in self._log['Run'][first:last] if run['data']['end'] >= start]
+
+    @staticmethod
+    def run_cursor(run):
+        """Returns a string identifying the run, which can be used to continue iter_runs after it."""
+        return '%s@%s' % (run['uid'], run['start'].strftime(_RunJournal.DATETIME_FORMAT))
+
+    def iter_runs(self, start=None, end=None, station=None, after=None):
+        """Returns an iterator over (dict) copies of all runs (active or finished) sorted on start.
+        The runs can be limited to those overlapping the period from start to end, those of the given station
+        and those following the run with the given cursor (see run_cursor). Only the references to the runs
+        are collected at once, each run is copied when it is needed."""
+        with self._lock:
+            if station is not None:
+                runs = self._station_runs.get(station, [])[:]
+            else:
+                first = bisect_left(self._run_max_ends, start) if start is not None else 0
+                last = bisect_right(self._run_starts, end) if end is not None else len(self._run_starts)
+                runs = [run['data'] for run in self._log['Run'][first:last]]
+
+        index = 0
+        if after is not None:
+            uid, _, after_start = after.rpartition('@')
+            after_start = datetime.datetime.strptime(after_start, _RunJournal.DATETIME_FORMAT)
+            starts = [run['start'] for run in runs]
+            index = bisect_left(starts, after_start)
+            last = bisect_right(starts, after_start, index)
+            for same_start in range(index, last):
+                if runs[same_start]['uid'] == uid:
+                    index = same_start + 1
+                    break
+            else:
+                index = last  # The run is no longer available
+
+        return (run.to_dict() for run in runs[index:]
+                if (start is None or run['end'] >= start) and (end is None or run['start'] <= end))
 
     def log_event(self, event_type, message, level=logging.INFO, format_msg=True):
         if threading.current_thread().__class__.__name__ != '_MainThread' and time.time() < self._plugin_time:
@@ -181,6 +597,11 @@ class _Log(logging.Handler):
         self.log_event(event_type, message, logging.ERROR)
 
     def clear_runs(self, all_entries=True):
+        if self._remove_runs(all_entries):
+            state_version.bump()
+
+    def _remove_runs(self, all_entries):
+        """Removes all runs (or the old runs that are no longer needed), returns whether runs were removed."""
         from ospy.programs import programs, ProgramType
         from ospy.stations import stations
         if all_entries or not options.run_log:  # User request or logging is disabled
@@ -188,33 +609,49 @@ class _Log(logging.Handler):
         elif options.run_entries > 0:
             minimum = options.run_entries
         else:
-            return  # We should not prune in this case
+            return False  # We should not prune in this case
+
+        if len(self._log['Run']) <= minimum:
+            return False  # Nothing to prune
 
-        # determine the start of the first active run:
-        first_start = min([datetime.datetime.now()] + [interval['start'] for interval in self.active_runs()])
         min_eto = datetime.date.today() + datetime.timedelta(days=1)
         for program in programs.get():
             if program.type == ProgramType.WEEKLY_WEATHER:
                 for station in program.stations:
                     min_eto = min(min_eto, min([datetime.date.today() - datetime.timedelta(days=7)] + list(stations.get(station).balance.keys())))
 
-        # Now try to remove as much as we can
-        for index in reversed(range(len(self._log['Run']) - minimum)):
-            interval = self._log['Run'][index]['data']
-
-            delete = True
-            # If this entry cannot have influence on the current state anymore:
-            if (first_start - interval['end']).total_seconds() <= max(options.station_delay + options.min_runtime,
-                                                                      options.master_off_delay,
-                                                                      60):
-                delete = False
-            elif interval['end'].date() >= min_eto:
-                delete = False
-
-            if delete:
-                del self._log['Run'][index]
-
-        self._save_logs()
+        with self._lock:
+            # determine the start of the first active run:
+            first_start = min([datetime.datetime.now()] + [interval['start'] for interval in self._active_runs()])
+
+            # Now try to remove as much as we can, only the first entries can be removed
+            prunable = len(self._log['Run']) - minimum
+            kept = []
+            removed = []
+            for run in self._log['Run'][:prunable]:
+                interval = run['data']
+
+                delete = True
+                # If this entry cannot have influence on the current state anymore:
+                if (first_start - interval['end']).total_seconds() <= max(options.station_delay + options.min_runtime,
+                                                                          options.master_off_delay,
+                                                                          60):
+                    delete = False
+                elif interval['end'].date() >= min_eto:
+                    delete = False
+
+                if delete:
+                    removed.append(run)
+                else:
+                    kept.append(run)
+
+            if not removed:
+                return False
+
+            self._log['Run'][:prunable] = kept
+            self._index_runs()
+            self._save_logs(removed=removed)
+        return True
 
     def clear(self, event_type):
         if event_type != 'Run':
@@ -3,9 +3,11 @@
 __author__ = 'Rimco'
 
 # System imports
+from contextlib import contextmanager
 from datetime import datetime, date
 from threading import Timer
 import logging
+import pickle
 import shelve
 import shutil
 import threading
@@ -19,6 +21,43 @@ from functools import reduce
 OPTIONS_FILE = './ospy/data/default/options.db'
 OPTIONS_TMP = './ospy/data/tmp/options.db'
 OPTIONS_BACKUP = './ospy/data/backup/options.db'
+OPTIONS_WAL = './ospy/data/options.wal'
+
+
+class _StateVersion(object):
+    """Counter that is increased on every change that could influence the schedule.
+    Can be used to check if cached results are still valid or to wait for changes.
+    Every increase is passed on to the given other versions as well."""
+
+    def __init__(self, *followers):
+        self._condition = threading.Condition()
+        self._value = 0
+        self._followers = followers
+
+    @property
+    def value(self):
+        return self._value
+
+    def bump(self, *args, **kwargs):
+        """Increases the version. Accepts (and ignores) any arguments to allow using it as callback."""
+        with self._condition:
+            self._value += 1
+            self._condition.notify_all()
+        for follower in self._followers:
+            follower.bump()
+
+    def wait(self, version, timeout):
+        """Waits at most timeout seconds until the version is different from the given version.
+        Returns the current version."""
+        with self._condition:
+            if self._value == version and timeout > 0:
+                self._condition.wait(timeout)
+            return self._value
+
+# Increased on every change of the outputs or the runs, and on every change of the state version:
+status_version = _StateVersion()
+state_version = _StateVersion(status_version)
+
 
 class _Options(object):
     # Using an array to preserve order
@@ -94,6 +133,24 @@ class _Options(object):
             "min": 1,
             "max": 65535
         },
+        {
+            "key": "web_threads",
+            "name": "HTTP worker threads",
+            "default": 10,
+            "help": "Number of requests that can be handled at the same time (effective after reboot.)",
+            "category": "System",
+            "min": 1,
+            "max": 64
+        },
+        {
+            "key": "web_keep_alive",
+            "name": "HTTP keep-alive timeout",
+            "default": 5,
+            "help": "Seconds to keep an idle connection open for further requests (effective after reboot.)",
+            "category": "System",
+            "min": 1,
+            "max": 120
+        },
         {
             "key": "enabled_plugins",
             "name": "Enabled plug-ins",
@@ -139,6 +196,21 @@ class _Options(object):
             "min": 8,
             "max": 1000
         },
+        {
+            "key": "gpio_backend",
+            "name": "GPIO backend",
+            "default": "auto",
+            "options": ["auto", "spi", "simulated"],
+            "help": "Hardware used for the outputs (effective after reboot.) Auto detects a Raspberry Pi or Beagle Bone Black, spi drives the shift registers using the SPI device, simulated only records all changes (for testing.)",
+            "category": "Station Handling"
+        },
+        {
+            "key": "spi_device",
+            "name": "SPI device",
+            "default": "/dev/spidev0.0",
+            "help": "SPI device used by the spi GPIO backend (effective after reboot.)",
+            "category": "Station Handling"
+        },
         {
             "key": "station_delay",
             "name": "Station delay",
@@ -273,29 +345,33 @@ class _Options(object):
             "name": "Current password decryption time",
             "default": 0,
         },
-        {
-            "key": "logged_runs",
-            "name": "The runs that have been logged",
-            "default": []
-        },
-        {
-            "key": "weather_cache",
-            "name": "ETo and rain value cache",
-            "default": {}
-        },
         {
             "key": "last_save",
             "name": "Timestamp of the last database save",
             "default": time.time()
+        },
+        {
+            "key": "wal_generation",
+            "name": "Generation of the write-ahead log belonging to the database",
+            "default": 0
         }
     ]
 
+    WAL_SIZE = 256*1024  # Write a new database if the write-ahead log grows larger than this
+    SNAPSHOT_INTERVAL = 3600  # Or if the last database was written longer ago than this
+
     def __init__(self):
         self._values = {}
         self._write_timer = None
+        self._batch_depth = 0
+        self._batch_lock = threading.Lock()
         self._callbacks = {}
         self._block = []
+        self._schemas = {}
         self._lock = threading.Lock()
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        self._snapshot_time = time.time()
 
         for info in self.OPTIONS:
             self._values[info["key"]] = info["default"]
@@ -321,6 +397,8 @@ class _Options(object):
             except Exception as err:
                 pass
 
+        self._wal_valid = self._replay_wal()
+
         if not self.password_salt:  # Password is not hashed yet
             self.password_salt = helpers.password_salt()
             self.password_hash = helpers.password_hash(self.password_hash, self.password_salt)
@@ -364,6 +442,8 @@ class _Options(object):
             super(_Options, self).__setattr__(key, value)
         else:
             self._values[key] = value
+            with self._dirty_lock:
+                self._dirty.add(key)
 
             if key in self._callbacks:
                 if value != self._callbacks[key]['last_value']:
@@ -374,24 +454,42 @@ class _Options(object):
                             logging.error('Callback failed:\n' + traceback.format_exc())
                     self._callbacks[key]['last_value'] = value
 
-            # Only write after 1 second without any more changes
-            if self._write_timer is not None:
-                self._write_timer.cancel()
-            self._write_timer = Timer(1.0, self._write)
-            self._write_timer.start()
+            state_version.bump()
+            self._schedule_write()
 
     def __delattr__(self, item):
         if item.startswith('_'):
             super(_Options, self).__delattr__(item)
         else:
             del self._values[item]
-
-            # Only write after 1 second without any more changes
+            with self._dirty_lock:
+                self._dirty.add(item)
+            state_version.bump()
+            self._schedule_write()
+
+    def _schedule_write(self):
+        # Only write after 1 second without any more changes
+        if self._batch_depth == 0:
             if self._write_timer is not None:
                 self._write_timer.cancel()
             self._write_timer = Timer(1.0, self._write)
             self._write_timer.start()
 
+    @contextmanager
+    def batch(self):
+        """Collects all changes made within the with-statement and schedules only one write at the end."""
+        with self._batch_lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._batch_lock:
+                self._batch_depth -= 1
+            with self._dirty_lock:
+                changed = bool(self._dirty)
+            if changed:
+                self._schedule_write()
+
     # Makes it possible to use this class like options[<item>]
     __getitem__ = __getattr__
 
@@ -405,7 +503,7 @@ class _Options(object):
         return item in self._values
 
     def _convert_datetime_to_str(self, inp):
-        if isinstance(inp, dict):
+        if isinstance(inp, dict) or hasattr(inp, 'keys'):  # Also dict-like objects such as run intervals
             result = {}
             for k in inp:
                 result[self._convert_datetime_to_str(k)] = self._convert_datetime_to_str(inp[k])
@@ -438,79 +536,165 @@ class _Options(object):
             result = inp
         return result
 
+    def _replay_wal(self):
+        """Applies all committed changes in the write-ahead log on top of the loaded database.
+        Returns False if there is no write-ahead log belonging to the loaded database."""
+        try:
+            with open(OPTIONS_WAL, 'rb') as fh:
+                if pickle.load(fh) != ('generation', self._values['wal_generation']):
+                    return False
+
+                changes = []
+                committed = fh.tell()
+                while True:
+                    try:
+                        record = pickle.load(fh)
+                    except Exception:
+                        break  # End of the log (or an interrupted write)
+
+                    if record[0] != 'commit':
+                        changes.append(record)
+                        continue
+
+                    for change in changes:
+                        if change[0] == 'set':
+                            self._values[change[1]] = self._convert_str_to_datetime(change[2])
+                        else:
+                            self._values.pop(change[1], None)
+                    changes = []
+                    committed = fh.tell()
+
+                # After an interrupted write we cannot append anymore, the next write will replace the log
+                return committed == os.fstat(fh.fileno()).st_size
+        except Exception:
+            return False
+
+    def _reset_wal(self):
+        """Starts an empty write-ahead log for the current database."""
+        helpers.mkdir_p(os.path.dirname(OPTIONS_WAL))
+        with open(OPTIONS_WAL + '.tmp', 'wb') as fh:
+            pickle.dump(('generation', self._values['wal_generation']), fh, 2)
+            fh.flush()
+            os.fsync(fh.fileno())
+        if os.path.exists(OPTIONS_WAL):
+            os.remove(OPTIONS_WAL)  # Windows cannot rename onto an existing file
+        os.rename(OPTIONS_WAL + '.tmp', OPTIONS_WAL)
+        self._wal_valid = True
+
+    def _append_wal(self, keys):
+        """Appends the current values of the given keys as a single commit to the write-ahead log."""
+        if not self._wal_valid:
+            self._reset_wal()
+
+        records = []
+        for key in keys:
+            if key in self._values:
+                value = self._values[key]
+                if helpers.is_python2():
+                    value = self._convert_datetime_to_str(value)
+                records.append(('set', key, value))
+            else:
+                records.append(('del', key))
+        records.append(('commit',))
+
+        with open(OPTIONS_WAL, 'ab') as fh:
+            fh.write(b''.join(pickle.dumps(record, 2) for record in records))
+            fh.flush()
+            os.fsync(fh.fileno())
+
     def _write(self):
-        """This function saves the current data to disk. Use a timer to limit the call rate."""
+        """This function saves the changed data to disk. Use a timer to limit the call rate.
+        Changes are appended to the write-ahead log, once in a while the complete database is written."""
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+
         try:
             with self._lock:
-                logging.debug('Saving options to disk')
+                if not self._wal_valid or not os.path.isfile(OPTIONS_WAL) or \
+                        os.path.getsize(OPTIONS_WAL) >= self.WAL_SIZE or \
+                        time.time() - self._snapshot_time >= self.SNAPSHOT_INTERVAL:
+                    self._write_snapshot()
+                elif dirty:
+                    logging.debug('Saving %d changed options to disk', len(dirty))
+                    self._append_wal(dirty)
+        except Exception:
+            logging.warning('Saving error:\n' + traceback.format_exc())
+            with self._dirty_lock:
+                self._dirty |= dirty  # Try again with the next write
 
-                options_dir = os.path.dirname(OPTIONS_FILE)
-                tmp_dir = os.path.dirname(OPTIONS_TMP)
-                backup_dir = os.path.dirname(OPTIONS_BACKUP)
+    def _write_snapshot(self):
+        """Saves the complete data to disk, this replaces the write-ahead log."""
+        self._values['wal_generation'] += 1
+        self._wal_valid = False
+        logging.debug('Saving options to disk')
 
-                if os.path.isdir(tmp_dir):
-                    shutil.rmtree(tmp_dir)
-                helpers.mkdir_p(tmp_dir)
+        options_dir = os.path.dirname(OPTIONS_FILE)
+        tmp_dir = os.path.dirname(OPTIONS_TMP)
+        backup_dir = os.path.dirname(OPTIONS_BACKUP)
 
-                if helpers.is_python2():
-                    from dumbdbm import open as dumb_open
-                else:
-                    from dbm.dumb import open as dumb_open
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        helpers.mkdir_p(tmp_dir)
 
-                db = shelve.Shelf(dumb_open(OPTIONS_TMP))
-                db.clear()
-                if helpers.is_python2():
-                    # We need to make sure that datetime objects are readable in Python 3
-                    # This conversion takes care of that as long as we run at least once in Python 2
-                    db.update(self._convert_datetime_to_str(self._values))
-                else:
-                    db.update(self._values)
+        if helpers.is_python2():
+            from dumbdbm import open as dumb_open
+        else:
+            from dbm.dumb import open as dumb_open
+
+        db = shelve.Shelf(dumb_open(OPTIONS_TMP))
+        db.clear()
+        if helpers.is_python2():
+            # We need to make sure that datetime objects are readable in Python 3
+            # This conversion takes care of that as long as we run at least once in Python 2
+            db.update(self._convert_datetime_to_str(self._values))
+        else:
+            db.update(self._values)
+
+        db.close()
 
-                db.close()
+        remove_backup = True
+        try:
+            db = shelve.open(OPTIONS_BACKUP)
+            if time.time() - db['last_save'] < 3600:
+                remove_backup = False
+            db.close()
+        except Exception:
+            pass
+        del db
 
-                remove_backup = True
+        if os.path.isdir(backup_dir) and remove_backup:
+            for i in range(10):
                 try:
-                    db = shelve.open(OPTIONS_BACKUP)
-                    if time.time() - db['last_save'] < 3600:
-                        remove_backup = False
-                    db.close()
+                    shutil.rmtree(backup_dir)
+                    break
                 except Exception:
-                    pass
-                del db
-
-                if os.path.isdir(backup_dir) and remove_backup:
-                    for i in range(10):
-                        try:
-                            shutil.rmtree(backup_dir)
-                            break
-                        except Exception:
-                            time.sleep(0.2)
-                    else:
-                        shutil.rmtree(backup_dir)
-
-                if os.path.isdir(options_dir):
-                    if not os.path.isdir(backup_dir):
-                        shutil.move(options_dir, backup_dir)
-                    else:
-                        for i in range(10):
-                            try:
-                                shutil.rmtree(options_dir)
-                                break
-                            except Exception:
-                                time.sleep(0.2)
-                        else:
-                            shutil.rmtree(options_dir)
+                    time.sleep(0.2)
+            else:
+                shutil.rmtree(backup_dir)
+
+        if os.path.isdir(options_dir):
+            if not os.path.isdir(backup_dir):
+                shutil.move(options_dir, backup_dir)
+            else:
+                for i in range(10):
+                    try:
+                        shutil.rmtree(options_dir)
+                        break
+                    except Exception:
+                        time.sleep(0.2)
+                else:
+                    shutil.rmtree(options_dir)
 
-                shutil.move(tmp_dir, options_dir)
+        shutil.move(tmp_dir, options_dir)
 
-                if helpers.is_python2():
-                    from whichdb import whichdb
-                else:
-                    from dbm import whichdb
+        if helpers.is_python2():
+            from whichdb import whichdb
+        else:
+            from dbm import whichdb
 
-                logging.debug('Saved db as %s', whichdb(OPTIONS_FILE))
-        except Exception:
-            logging.warning('Saving error:\n' + traceback.format_exc())
+        logging.debug('Saved db as %s', whichdb(OPTIONS_FILE))
+        self._snapshot_time = time.time()
+        self._reset_wal()
 
     def get_categories(self):
         result = []
@@ -537,13 +721,26 @@ class _Options(object):
         tpy = (obj if isinstance(obj, type) else type(obj))
         return 'Cls_' + tpy.__module__ + '_' + tpy.__name__ + '_' + str(key).replace(' ', '_')
 
+    def _fields(self, obj):
+        """Returns the names in SAVE_FIELDS of the class of obj, determined once per class."""
+        tpy = type(obj)
+        fields = self._schemas.get(tpy)
+        if fields is None:
+            fields = self._schemas[tpy] = tuple(tpy.SAVE_FIELDS)
+        return fields
+
     def load(self, obj, key=""):
         cls = self.cls_name(obj, key)
         self._block.append(cls)
         try:
             values = getattr(self, cls)
-            for name, value in values.items():
-                setattr(obj, name, value)
+            if hasattr(obj, 'SAVE_FIELDS'):
+                for name in self._fields(obj):
+                    if name in values:
+                        setattr(obj, name, values[name])
+            else:
+                for name, value in values.items():
+                    setattr(obj, name, value)
         except AttributeError:
             pass
         self._block.remove(cls)
@@ -551,11 +748,16 @@ class _Options(object):
     def save(self, obj, key=""):
         cls = self.cls_name(obj, key)
         if cls not in self._block:
-            values = {}
-            exclude = obj.SAVE_EXCLUDE if hasattr(obj, 'SAVE_EXCLUDE') else []
-            for attr in [att for att in dir(obj) if not att.startswith('_') and att not in exclude]:
-                if not hasattr(getattr(obj, attr), '__call__'):
-                    values[attr] = getattr(obj, attr)
+            if hasattr(obj, 'SAVE_FIELDS'):
+                values = {name: getattr(obj, name) for name in self._fields(obj)}
+            else:
+                # Without SAVE_FIELDS all public attributes are saved, these can differ per object and per save
+                values = {}
+                exclude = obj.SAVE_EXCLUDE if hasattr(obj, 'SAVE_EXCLUDE') else []
+                for attr in [att for att in dir(obj) if not att.startswith('_') and att not in exclude]:
+                    value = getattr(obj, attr)
+                    if not hasattr(value, '__call__'):
+                        values[attr] = value
 
             setattr(self, cls, values)
 
@@ -571,7 +773,43 @@ class _Options(object):
 options = _Options()
 
 
-class _LevelAdjustments(dict):
+class _StateDict(dict):
+    """Dictionary that increases the state version on every change."""
+
+    def __setitem__(self, key, value):
+        super(_StateDict, self).__setitem__(key, value)
+        state_version.bump()
+
+    def __delitem__(self, key):
+        super(_StateDict, self).__delitem__(key)
+        state_version.bump()
+
+    def pop(self, *args):
+        result = super(_StateDict, self).pop(*args)
+        state_version.bump()
+        return result
+
+    def popitem(self):
+        result = super(_StateDict, self).popitem()
+        state_version.bump()
+        return result
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def update(self, *args, **kwargs):
+        super(_StateDict, self).update(*args, **kwargs)
+        state_version.bump()
+
+    def clear(self):
+        super(_StateDict, self).clear()
+        state_version.bump()
+
+
+class _LevelAdjustments(_StateDict):
     def __init__(self):
         super(_LevelAdjustments, self).__init__()
 
@@ -581,7 +819,7 @@ class _LevelAdjustments(dict):
 level_adjustments = _LevelAdjustments()
 
 
-class _RainBlocks(dict):
+class _RainBlocks(_StateDict):
     def __init__(self):
         super(_RainBlocks, self).__init__()
 
@@ -4,6 +4,9 @@ __author__ = 'Rimco'
 
 import logging
 
+from ospy import gpio
+from ospy.options import options
+
 
 class _DummyOutputs(object):
     def __init__(self):
@@ -35,12 +38,8 @@ class _IOOutputs(object):
 
 class _RPiOutputs(_IOOutputs):
     def __init__(self):
-        import RPi.GPIO as GPIO  # RPi hardware
-
         super(_RPiOutputs, self).__init__()
-        self._io = GPIO
-        self._io.setwarnings(False)
-        self._io.setmode(self._io.BOARD)
+        self._io = gpio.rpi()
 
         self._mapping = {
             'relay_output': 10
@@ -49,23 +48,33 @@ class _RPiOutputs(_IOOutputs):
 
 class _BBBOutputs(_IOOutputs):
     def __init__(self):
-        import Adafruit_BBIO.GPIO as GPIO  # Beagle Bone Black hardware
-
         super(_BBBOutputs, self).__init__()
-        self._io = GPIO
-        self._io.setwarnings(False)
+        self._io = gpio.bbb()
 
         self._mapping = {
             'relay_output': "P9_16"
         }
 
 
-try:
-    outputs = _RPiOutputs()
-except Exception as err:
-    logging.debug(err)
+class _SimulatedOutputs(_IOOutputs):
+    def __init__(self):
+        super(_SimulatedOutputs, self).__init__()
+        self._io = gpio.simulated()
+
+        self._mapping = {
+            'relay_output': 10
+        }
+
+
+if options.gpio_backend == 'simulated':
+    outputs = _SimulatedOutputs()
+else:
     try:
-        outputs = _BBBOutputs()
+        outputs = _RPiOutputs()
     except Exception as err:
         logging.debug(err)
-        outputs = _DummyOutputs()
\ No newline at end of file
+        try:
+            outputs = _BBBOutputs()
+        except Exception as err:
+            logging.debug(err)
+            outputs = _DummyOutputs()
\ No newline at end of file
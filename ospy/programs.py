@@ -7,10 +7,11 @@ import datetime
 import logging
 import traceback
 import math
+from bisect import bisect_left, bisect_right
 
 # Local imports
 from ospy.helpers import minute_time_str, short_day
-from ospy.options import options
+from ospy.options import options, state_version
 from ospy.weather import weather
 from ospy.stations import stations
 from ospy.log import log
@@ -39,9 +40,12 @@ ProgramType.NAMES = {getattr(ProgramType, x): x for x in dir(ProgramType) if not
                                                                              isinstance(getattr(ProgramType, x), int)}
 
 class _Program(object):
-    SAVE_EXCLUDE = ['SAVE_EXCLUDE', 'index', '_programs', '_loading']
+    SAVE_FIELDS = ['cut_off', 'enabled', 'fixed', 'manual', 'modulo', 'name', 'schedule', 'start', 'stations',
+                   'type', 'type_data']  # Loaded in this order, modulo is needed to load start
+    SAVE_EXCLUDE = ['_programs', '_index', '_loading', '_station_bounds']  # Changing these doesn't require saving
 
     def __init__(self, programs_instance, index):
+        self._index = -1  # Assigned by the programs instance once this program is part of it
         self._programs = programs_instance
         self._loading = True
 
@@ -54,6 +58,7 @@ class _Program(object):
 
         self._schedule = []
         self._station_schedule = {}
+        self._station_bounds = {}
         self._modulo = 24*60
         self._manual = False  # Non-repetitive (run-once) if True
         self._start = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
@@ -68,10 +73,7 @@ class _Program(object):
 
     @property
     def index(self):
-        try:
-            return self._programs.get().index(self)
-        except ValueError:
-            return -1
+        return self._index
 
     @property
     def stations(self):
@@ -96,6 +98,8 @@ class _Program(object):
                                                    datetime.time.min)
             last_start = self._start
             self._start = week_start
+            if week_start != last_start:
+                self._save()
             start_difference = int(round((week_start - last_start).total_seconds() / 60))
             irrigation_min, irrigation_max, run_max, pause_ratio, pem_mins = self.type_data
 
@@ -196,6 +200,9 @@ class _Program(object):
             except Exception:
                 logging.warning('Could not create weather based schedule:\n' + traceback.format_exc())
 
+        self._station_bounds = {}
+        state_version.bump()
+
     @property
     def schedule(self):
         return [interval[:] for interval in self._schedule]
@@ -342,6 +349,7 @@ class _Program(object):
     def clear(self):
         self._schedule = []
         self.update_station_schedule()
+        self._save()
 
     def set_days_simple(self, start_min, duration_min, pause_min, repeat_times, days):
         new_schedule = []
@@ -362,6 +370,7 @@ class _Program(object):
 
         self._schedule = new_schedule
         self.update_station_schedule()
+        self._save()
 
     def set_days_advanced(self, schedule, days):
         new_schedule = []
@@ -381,6 +390,7 @@ class _Program(object):
 
         self._schedule = new_schedule
         self.update_station_schedule()
+        self._save()
 
     def set_repeat_simple(self, start_min, duration_min, pause_min, repeat_times, repeat_days, start_date):
         new_schedule = []
@@ -398,6 +408,7 @@ class _Program(object):
 
         self._schedule = new_schedule
         self.update_station_schedule()
+        self._save()
 
     def set_repeat_advanced(self, schedule, repeat_days, start_date):
         new_schedule = []
@@ -416,6 +427,7 @@ class _Program(object):
 
         self._schedule = new_schedule
         self.update_station_schedule()
+        self._save()
 
     def set_weekly_advanced(self, schedule):
         new_schedule = []
@@ -433,6 +445,7 @@ class _Program(object):
 
         self._schedule = new_schedule
         self.update_station_schedule()
+        self._save()
 
     def set_weekly_weather(self, irrigation_min, irrigation_max, run_max, pause_min, pems):
         new_schedule = []
@@ -457,6 +470,7 @@ class _Program(object):
 
         self._schedule = new_schedule
         self.update_station_schedule()
+        self._save()
 
     # The following functions provide easy access to data of different types, returns default if not available
 
@@ -590,11 +604,29 @@ class _Program(object):
 
         return new_schedule
 
+    def _schedule_bounds(self, station):
+        """Returns the schedule of the given station together with the start minutes of its entries
+        and the running maximum of their end minutes (to allow bisecting)."""
+        bounds = self._station_bounds.get(station)
+        if bounds is None:
+            schedule = self._station_schedule.get(station, [])
+            for other_bounds in self._station_bounds.values():
+                if other_bounds[0] is schedule:
+                    # Stations sharing the same schedule also share its bounds:
+                    self._station_bounds[station] = other_bounds
+                    return other_bounds
+
+            starts = []
+            max_ends = []
+            for entry in schedule:
+                starts.append(entry[0])
+                max_ends.append(entry[1] if not max_ends else max(max_ends[-1], entry[1]))
+            bounds = (schedule, starts, max_ends)
+            self._station_bounds[station] = bounds
+        return bounds
+
     def is_active(self, date_time, station):
-        if station in self._station_schedule:
-            schedule = self._station_schedule[station]
-        else:
-            schedule = []
+        schedule, starts, max_ends = self._schedule_bounds(station)
 
         time_delta = date_time - self.start
         minute_delta = time_delta.days*24*60 + int(time_delta.seconds/60)
@@ -604,26 +636,35 @@ class _Program(object):
 
         current_minute = minute_delta % self.modulo
 
-        result = False
-        for entry in schedule:
-            if entry[0] <= current_minute < entry[1]:
-                result = True
-                break
-            elif entry[0] <= current_minute+self.modulo < entry[1]:
-                result = True
-                break
-            elif entry[0] > current_minute:
-                break
-
+        # Entries starting before the current minute:
+        index = bisect_right(starts, current_minute)
+        if index > 0 and max_ends[index-1] > current_minute:
+            return True
+
+        # The first entry starting after the current minute might still wrap around:
+        return index < len(schedule) and schedule[index][0] <= current_minute+self.modulo < schedule[index][1]
+
+    def iter_active_intervals(self, date_time_start, date_time_end, station):
+        """Generates (start, end) tuples of all intervals of the given station overlapping the given period."""
+        return self._iter_intervals(self._schedule_bounds(station), date_time_start, date_time_end)
+
+    def active_intervals_for_stations(self, date_time_start, date_time_end, stations):
+        """Returns a dict mapping each of the given stations to a list of its (start, end) intervals.
+        The intervals are only computed once for all stations sharing the same schedule."""
+        result = {}
+        computed = {}
+        for station in stations:
+            bounds = self._schedule_bounds(station)
+            if id(bounds) not in computed:
+                computed[id(bounds)] = list(self._iter_intervals(bounds, date_time_start, date_time_end))
+            result[station] = computed[id(bounds)]
         return result
 
-    def active_intervals(self, date_time_start, date_time_end, station):
-        if station in self._station_schedule:
-            schedule = self._station_schedule[station]
-        else:
-            schedule = []
+    def _iter_intervals(self, bounds, date_time_start, date_time_end):
+        schedule, starts, max_ends = bounds
+        if not schedule:
+            return
 
-        result = []
         if self.manual:
             current_date_time = self.start
         else:
@@ -633,28 +674,28 @@ class _Program(object):
                                                                      seconds=date_time_start.second,
                                                                      microseconds=date_time_start.microsecond)
 
+        modulo_delta = datetime.timedelta(minutes=self.modulo)
         while current_date_time < date_time_end:
-            for entry in schedule:
+            # Only consider the entries that end after the start and start before the end:
+            first = bisect_right(max_ends, (date_time_start - current_date_time).total_seconds() / 60)
+            last = bisect_left(starts, (date_time_end - current_date_time).total_seconds() / 60)
+            for entry in schedule[first:last]:
                 start = current_date_time + datetime.timedelta(minutes=entry[0])
                 end = current_date_time + datetime.timedelta(minutes=entry[1])
 
                 if end <= date_time_start:
                     continue
 
-                if start >= date_time_end:
-                    break
-
-                result.append({
-                    'start': start,
-                    'end': end
-                })
+                yield start, end
 
             if self.manual:
                 break
 
-            current_date_time += datetime.timedelta(minutes=self.modulo)
+            current_date_time += modulo_delta
 
-        return result
+    def active_intervals(self, date_time_start, date_time_end, station):
+        return [{'start': start, 'end': end}
+                for start, end in self.iter_active_intervals(date_time_start, date_time_end, station)]
 
     def __setattr__(self, key, value):
         if key == 'modulo':
@@ -663,8 +704,11 @@ class _Program(object):
                 self.schedule = self._schedule  # Convert to custom sequence
         elif key == 'manual':
             self._manual = value
-            if not self._loading and value:
-                self.schedule = self._schedule  # Convert to custom sequence
+            if not self._loading:
+                if value:
+                    self.schedule = self._schedule  # Convert to custom sequence
+                else:
+                    self._save()
         elif key == 'start':
             if self._loading:  # Update start date to most recent possible
                 while value <= datetime.datetime.today():
@@ -675,19 +719,25 @@ class _Program(object):
                 self.schedule = self._schedule  # Convert to custom sequence
         else:
             super(_Program, self).__setattr__(key, value)
-            if key not in self.SAVE_EXCLUDE:
-                if not self._loading and self.index >= 0:
-                    options.save(self, self.index)
+            if key in self.SAVE_FIELDS:
+                self._save()
+
+    def _save(self):
+        """Saves this program, needed after changing the attributes behind the properties in SAVE_FIELDS."""
+        if not self._loading and self.index >= 0:
+            options.save(self, self.index)
 
 
 class _Programs(object):
     def __init__(self):
         self._programs = []
-        self.run_now_program = None
+        self._run_now_program = None
 
         i = 0
         while options.available(_Program, i):
-            self._programs.append(_Program(self, i))
+            program = _Program(self, i)
+            program._index = i
+            self._programs.append(program)
             i += 1
 
         options.add_callback('output_count', self._option_cb)
@@ -698,9 +748,36 @@ class _Programs(object):
         for program in self._programs:
             program.stations = [station for station in program.stations if 0 <= station < new]
 
+    @property
+    def run_now_program(self):
+        return self._run_now_program
+
+    @run_now_program.setter
+    def run_now_program(self, value):
+        self._run_now_program = value
+        state_version.bump()
+
     def calculate_balances(self):
         from .scheduler import predicted_schedule
         now = datetime.datetime.now()
+
+        # Collect the weather information for all days that need it at once:
+        weather_days = set()
+        for station in stations.get():
+            calc_day = now.date() - datetime.timedelta(days=20)
+            while calc_day < now.date() + datetime.timedelta(days=7):
+                if calc_day not in station.balance or not station.balance[calc_day]['valid'] or \
+                        calc_day >= now.date() - datetime.timedelta(days=1):
+                    weather_days.add(calc_day)
+                calc_day += datetime.timedelta(days=1)
+        weather_data = weather.get_eto_and_rain(sorted(weather_days))
+
+        # Predict the schedule of the coming days only once for all stations:
+        predicted_runs = {}
+        for run in predicted_schedule(now, datetime.datetime.combine(now.date() + datetime.timedelta(days=6), datetime.time.max)):
+            if not run['blocked']:
+                predicted_runs.setdefault((run['station'], max(run['start'].date(), now.date())), []).append(run)
+
         for station in stations.get():
             station.balance = {key: value for key, value in station.balance.items()
                                if key >= now.date() - datetime.timedelta(days=21)}
@@ -714,7 +791,8 @@ class _Programs(object):
                     'valid': True
                 }
 
-            runs = log.finished_runs() + log.active_runs()
+            runs = log.runs_for_station(station.index)
+            run_index = 0
             calc_day = now.date() - datetime.timedelta(days=20)
             while calc_day < now.date() + datetime.timedelta(days=7):
                 if calc_day not in station.balance:
@@ -725,19 +803,19 @@ class _Programs(object):
                         'total': 0.0,
                         'valid': False
                     }
-                try:
-                    if not station.balance[calc_day]['valid'] or calc_day >= now.date() - datetime.timedelta(days=1):
-                        station.balance[calc_day]['eto'] = station.eto_factor * weather.get_eto(calc_day)
-                        station.balance[calc_day]['rain'] = 0.0 if station.ignore_rain else weather.get_rain(calc_day)
+                if not station.balance[calc_day]['valid'] or calc_day >= now.date() - datetime.timedelta(days=1):
+                    if calc_day in weather_data:
+                        eto, rain = weather_data[calc_day]
+                        station.balance[calc_day]['eto'] = station.eto_factor * eto
+                        station.balance[calc_day]['rain'] = 0.0 if station.ignore_rain else rain
                         station.balance[calc_day]['valid'] = True
-                except Exception:
-                    station.balance[calc_day]['valid'] = False
-                    logging.warning('Could not get weather information, using fallbacks:\n' + traceback.format_exc())
+                    else:
+                        station.balance[calc_day]['valid'] = False
 
                 intervals = []
-                while runs and runs[0]['start'].date() <= calc_day:
-                    run = runs[0]
-                    if runs[0]['start'].date() == calc_day and not run['blocked'] and run['station'] == station.index:
+                while run_index < len(runs) and runs[run_index]['start'].date() <= calc_day:
+                    run = runs[run_index]
+                    if run['start'].date() == calc_day and not run['blocked'] and run['station'] == station.index:
                         irrigation = (run['end'] - run['start']).total_seconds() / 3600 * station.precipitation
                         if run['manual']:
                             irrigation *= 0.5  # Only count half in case of manual runs
@@ -747,23 +825,16 @@ class _Programs(object):
                             'done': True,
                             'irrigation': irrigation
                         })
-                    del runs[0]
+                    run_index += 1
 
-                if calc_day >= now.date():
-                    if calc_day == now.date():
-                        date_time_start = now
-                    else:
-                        date_time_start = datetime.datetime.combine(calc_day, datetime.time.min)
-                    date_time_end = datetime.datetime.combine(calc_day, datetime.time.max)
-                    for run in predicted_schedule(date_time_start, date_time_end):
-                        if not run['blocked'] and run['station'] == station.index:
-                            irrigation = (run['end'] - run['start']).total_seconds() / 3600 * station.precipitation
-                            intervals.append({
-                                'program': run['program'],
-                                'program_name': run['program_name'],
-                                'done': False,
-                                'irrigation': irrigation
-                            })
+                for run in predicted_runs.get((station.index, calc_day), []):
+                    irrigation = (run['end'] - run['start']).total_seconds() / 3600 * station.precipitation
+                    intervals.append({
+                        'program': run['program'],
+                        'program_name': run['program_name'],
+                        'done': False,
+                        'irrigation': irrigation
+                    })
 
                 if len(intervals) > len(station.balance[calc_day]['intervals']) or calc_day >= now.date():
                     station.balance[calc_day]['intervals'] = intervals
@@ -793,6 +864,7 @@ class _Programs(object):
     def add_program(self, program=None):
         if program is None:
             program = _Program(self, len(self._programs))
+        program._index = len(self._programs)
         self._programs.append(program)
         options.save(program, program.index)
 
@@ -802,9 +874,10 @@ class _Programs(object):
 
     def remove_program(self, index):
         if 0 <= index < len(self._programs):
-            del self._programs[index]
+            self._programs.pop(index)._index = -1
 
         for i in range(index, len(self._programs)):
+            self._programs[i]._index = i
             options.save(self._programs[i], i)  # Save programs using new indices
 
         options.erase(_Program, len(self._programs))  # Remove info in last index
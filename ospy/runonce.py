@@ -6,6 +6,7 @@ __author__ = 'Rimco'
 import datetime
 
 # Local imports
+from ospy.options import state_version
 
 
 class _RunOnceProgram(object):
@@ -18,11 +19,13 @@ class _RunOnceProgram(object):
     def clear(self):
         for station in self._station_seconds:
             self._station_seconds[station] = 0
+        state_version.bump()
 
     def set(self, station_seconds):
         """The argument should map station indices to durations in seconds."""
         self._start = datetime.datetime.now()
         self._station_seconds = station_seconds.copy()
+        state_version.bump()
 
     def is_active(self, date_time, station):
         seconds = (date_time - self._start).total_seconds()
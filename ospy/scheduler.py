@@ -5,8 +5,8 @@ __author__ = 'Rimco'
 # System imports
 from threading import Thread
 import datetime
-import time
 import logging
+import random
 import traceback
 
 # Local imports
@@ -15,12 +15,288 @@ from ospy.log import log
 from ospy.options import level_adjustments
 from ospy.options import options
 from ospy.options import rain_blocks
+from ospy.options import state_version
+from ospy.options import status_version
 from ospy.programs import programs
 from ospy.runonce import run_once
 from ospy.stations import stations
 from ospy.outputs import outputs
 
 
+class _UsageNode(object):
+    __slots__ = ['key', 'delta', 'priority', 'left', 'right', 'total', 'peak', 'low']
+
+    def __init__(self, key, delta):
+        self.key = key
+        self.delta = delta
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.total = delta
+        self.peak = delta
+        self.low = delta
+
+    def update(self):
+        """Recalculates the sum of all changes and the maximum/minimum running sum of this subtree."""
+        left_total = 0
+        here = self.delta
+        peak = low = None
+        if self.left is not None:
+            left_total = self.left.total
+            here += left_total
+            peak = max(self.left.peak, here)
+            low = min(self.left.low, here)
+        else:
+            peak = low = here
+
+        total = here
+        if self.right is not None:
+            peak = max(peak, here + self.right.peak)
+            low = min(low, here + self.right.low)
+            total += self.right.total
+
+        self.total = total
+        self.peak = peak
+        self.low = low
+
+
+class _UsageIndex(object):
+    """Keeps track of usage changes sorted on time (using a treap).
+    Every node also stores the sum and the maximum/minimum running sum of its subtree,
+    this makes it possible to find the usage at a certain point in time or the
+    peak usage in a certain period in O(log n)."""
+
+    IDLE_USAGE = 0.01
+
+    def __init__(self):
+        self._root = None
+
+    def add(self, key, delta):
+        """Adds a usage change at the given time."""
+        self._root = self._add(self._root, key, delta)
+
+    def add_interval(self, start, end, usage):
+        self.add(start, usage)
+        self.add(end, -usage)
+
+    @staticmethod
+    def _rotate_right(node):
+        result = node.left
+        node.left = result.right
+        result.right = node
+        node.update()
+        result.update()
+        return result
+
+    @staticmethod
+    def _rotate_left(node):
+        result = node.right
+        node.right = result.left
+        result.left = node
+        node.update()
+        result.update()
+        return result
+
+    def _add(self, node, key, delta):
+        if node is None:
+            return _UsageNode(key, delta)
+
+        if key == node.key:
+            node.delta += delta
+        elif key < node.key:
+            node.left = self._add(node.left, key, delta)
+            if node.left.priority > node.priority:
+                return self._rotate_right(node)
+        else:
+            node.right = self._add(node.right, key, delta)
+            if node.right.priority > node.priority:
+                return self._rotate_left(node)
+
+        node.update()
+        return node
+
+    def delta(self, key):
+        """Returns the usage change exactly at the given time."""
+        node = self._root
+        while node is not None:
+            if key == node.key:
+                return node.delta
+            node = node.left if key < node.key else node.right
+        return 0
+
+    def usage(self, key):
+        """Returns the usage just after the given time (including all changes at that time)."""
+        result = 0
+        node = self._root
+        while node is not None:
+            if key < node.key:
+                node = node.left
+            else:
+                result += (node.left.total if node.left is not None else 0) + node.delta
+                node = node.right
+        return result
+
+    def next_key(self, key):
+        """Returns the first time after the given time where the usage changes, None if there is none."""
+        result = None
+        node = self._root
+        while node is not None:
+            if node.key > key:
+                result = node.key
+                node = node.left
+            else:
+                node = node.right
+        return result
+
+    def previous_key(self, key):
+        """Returns the last time before the given time where the usage changes, None if there is none."""
+        result = None
+        node = self._root
+        while node is not None:
+            if node.key < key:
+                result = node.key
+                node = node.right
+            else:
+                node = node.left
+        return result
+
+    def last_decrease(self, key):
+        """Returns the last time after the given time where the usage decreases, None if there is none."""
+        node = self._root
+        while node is not None and node.right is not None:
+            node = node.right
+        result = node.key if node is not None else None
+        while result is not None and result > key and self.delta(result) >= 0:
+            result = self.previous_key(result)
+        return result if result is not None and result > key else None
+
+    def peak(self, low, high):
+        """Returns the maximum usage for all changes in the range (low, high), None if there are no changes."""
+        return self._peak(self._root, low, high, 0, True, True)
+
+    def _peak(self, node, low, high, offset, bounded_low, bounded_high):
+        if node is None:
+            return None
+        if not bounded_low and not bounded_high:
+            return offset + node.peak
+
+        left_total = node.left.total if node.left is not None else 0
+        if bounded_low and node.key <= low:
+            return self._peak(node.right, low, high, offset + left_total + node.delta, True, bounded_high)
+        if bounded_high and node.key >= high:
+            return self._peak(node.left, low, high, offset, bounded_low, True)
+
+        # This node is in range, so everything to the left is bounded by high and vice versa
+        here = offset + left_total + node.delta
+        result = here
+        for sub_peak in [self._peak(node.left, low, high, offset, bounded_low, False),
+                         self._peak(node.right, low, high, here, False, bounded_high)]:
+            if sub_peak is not None:
+                result = max(result, sub_peak)
+        return result
+
+    def last_above(self, low, high, limit):
+        """Returns the last time in the range (low, high) after which the usage is above the limit, None if there is none."""
+        return self._last_above(self._root, low, high, 0, limit, True, True)
+
+    def _last_above(self, node, low, high, offset, limit, bounded_low, bounded_high):
+        if node is None or (not bounded_low and not bounded_high and offset + node.peak <= limit):
+            return None
+
+        left_total = node.left.total if node.left is not None else 0
+        if bounded_low and node.key <= low:
+            return self._last_above(node.right, low, high, offset + left_total + node.delta, limit, True, bounded_high)
+        if bounded_high and node.key >= high:
+            return self._last_above(node.left, low, high, offset, limit, bounded_low, True)
+
+        here = offset + left_total + node.delta
+        result = self._last_above(node.right, low, high, here, limit, False, bounded_high)
+        if result is None and here > limit:
+            result = node.key
+        if result is None:
+            result = self._last_above(node.left, low, high, offset, limit, bounded_low, False)
+        return result
+
+    def first_below(self, low, limit):
+        """Returns the first time after the given time after which the usage is at most the limit, None if there is none."""
+        return self._first_below(self._root, low, 0, limit, True)
+
+    def _first_below(self, node, low, offset, limit, bounded):
+        if node is None or (not bounded and offset + node.low > limit):
+            return None
+
+        left_total = node.left.total if node.left is not None else 0
+        if bounded and node.key <= low:
+            return self._first_below(node.right, low, offset + left_total + node.delta, limit, True)
+
+        here = offset + left_total + node.delta
+        result = self._first_below(node.left, low, offset, limit, bounded)
+        if result is None and here <= limit:
+            result = node.key
+        if result is None:
+            result = self._first_below(node.right, low, here, limit, False)
+        return result
+
+    def last_idle(self, key):
+        """Returns the last time before the given time after which nothing was running, None if there is none."""
+        return self._last_idle(self._root, key, 0, True)
+
+    def _last_idle(self, node, high, offset, bounded):
+        if node is None or (not bounded and offset + node.low >= self.IDLE_USAGE):
+            return None
+
+        left_total = node.left.total if node.left is not None else 0
+        if bounded and node.key >= high:
+            return self._last_idle(node.left, high, offset, True)
+
+        here = offset + left_total + node.delta
+        result = self._last_idle(node.right, high, here, bounded)
+        if result is None and here < self.IDLE_USAGE:
+            result = node.key
+        if result is None:
+            result = self._last_idle(node.left, high, offset, False)
+        return result
+
+    def running_since(self, key):
+        """Determines since when we have been running without interruption when arriving at the given time.
+        Returns the given time if this could not be determined."""
+        no_gap = datetime.timedelta(seconds=3)
+        idle = self.last_idle(key)
+        while idle is not None:
+            started = self.next_key(idle)
+
+            # Find the moment we stopped running before this start:
+            stopped = idle
+            while stopped is not None and self.delta(stopped) >= 0:
+                stopped = self.last_idle(stopped)
+            if stopped is None:
+                break  # We have never been stopped before
+
+            if started < key and self.delta(started) > 0 and started - stopped > no_gap:
+                return started
+
+            idle = self.last_idle(idle)
+        return key
+
+
+def _scheduled_stations(program):
+    """Returns the sorted stations of the program that can actually be scheduled."""
+    return [station for station in sorted(program.stations)
+            if station < stations.count() and stations.master != station and stations[station].enabled]
+
+
+def _shifted_start(usage_index, option, delay_delta):
+    """Returns the start of an interval that is shifted to the given moment with lower usage.
+    The station delay is skipped if the running stations have not reached the minimum runtime yet."""
+    if options.min_runtime > 0:
+        # Try to determine how long we have been running at this point:
+        min_runtime_delta = datetime.timedelta(seconds=options.min_runtime)
+        running_since = usage_index.running_since(option)
+        if option - running_since < min_runtime_delta:
+            return option
+    return option + delay_delta
+
+
 def predicted_schedule(start_time, end_time):
     """Determines all schedules for the given time range.
     To calculate what should currently be active, a start time of some time (a day) ago should be used."""
@@ -35,17 +311,9 @@ def predicted_schedule(start_time, end_time):
     skip_intervals = log.finished_runs() + log.active_runs()
     current_active = [interval for interval in skip_intervals if not interval['blocked']]
 
-    usage_changes = {}
+    usage_index = _UsageIndex()
     for active in current_active:
-        start = active['start']
-        end = active['end']
-        if start not in usage_changes:
-            usage_changes[start] = 0
-        if end not in usage_changes:
-            usage_changes[end] = 0
-
-        usage_changes[start] += active['usage']
-        usage_changes[end] -= active['usage']
+        usage_index.add_interval(active['start'], active['end'], active['usage'])
 
     station_schedules = {}
 
@@ -75,12 +343,10 @@ def predicted_schedule(start_time, end_time):
     # Get run-now information:
     if programs.run_now_program is not None:
         program = programs.run_now_program
-        for station in sorted(program.stations):
-            run_now_intervals = program.active_intervals(start_time, end_time, station)
-            for interval in run_now_intervals:
-                if station >= stations.count() or stations.master == station or not stations[station].enabled:
-                    continue
-
+        program_stations = _scheduled_stations(program)
+        program_intervals = program.active_intervals_for_stations(start_time, end_time, program_stations)
+        for station in program_stations:
+            for interval_start, interval_end in program_intervals[station]:
                 if station not in station_schedules:
                     station_schedules[station] = []
 
@@ -94,10 +360,10 @@ def predicted_schedule(start_time, end_time):
                     'cut_off': 0,
                     'manual': True,
                     'blocked': False,
-                    'start': interval['start'],
-                    'original_start': interval['start'],
-                    'end': interval['end'],
-                    'uid': '%s-%s-%d' % (str(interval['start']), program_name, station),
+                    'start': interval_start,
+                    'original_start': interval_start,
+                    'end': interval_end,
+                    'uid': '%s-%s-%d' % (str(interval_start), program_name, station),
                     'usage': stations.get(station).usage
                 }
                 station_schedules[station].append(new_schedule)
@@ -107,17 +373,14 @@ def predicted_schedule(start_time, end_time):
         if not program.enabled:
             continue
 
-        for station in sorted(program.stations):
-            program_intervals = program.active_intervals(start_time, end_time, station)
-
-            if station >= stations.count() or stations.master == station or not stations[station].enabled:
-                continue
-
+        program_stations = _scheduled_stations(program)
+        program_intervals = program.active_intervals_for_stations(start_time, end_time, program_stations)
+        for station in program_stations:
             if station not in station_schedules:
                 station_schedules[station] = []
 
-            for interval in program_intervals:
-                if current_active and current_active[-1]['original_start'] > interval['start']:
+            for interval_start, interval_end in program_intervals[station]:
+                if current_active and current_active[-1]['original_start'] > interval_start:
                     continue
 
                 new_schedule = {
@@ -128,10 +391,10 @@ def predicted_schedule(start_time, end_time):
                     'cut_off': program.cut_off/100.0,
                     'manual': program.manual,
                     'blocked': False,
-                    'start': interval['start'],
-                    'original_start': interval['start'],
-                    'end': interval['end'],
-                    'uid': '%s-%d-%d' % (str(interval['start']), program.index, station),
+                    'start': interval_start,
+                    'original_start': interval_start,
+                    'end': interval_end,
+                    'uid': '%s-%d-%d' % (str(interval_start), program.index, station),
                     'usage': stations.get(station).usage
                 }
                 station_schedules[station].append(new_schedule)
@@ -163,12 +426,8 @@ def predicted_schedule(start_time, end_time):
                 interval['end'] += time_delta
             last_end = interval['end']
 
-            new_interval = {
-                'station': station
-            }
-            new_interval.update(interval)
-
-            all_intervals.append(new_interval)
+            interval['station'] = station
+            all_intervals.append(interval)
 
     # Make list of entries sorted on duration and time (stable sorted on station #)
     all_intervals.sort(key=lambda inter: inter['end'] - inter['start'])
@@ -208,82 +467,56 @@ def predicted_schedule(start_time, end_time):
             continue
 
         if max_usage > 0:
-            usage_keys = sorted(usage_changes.keys())
-            start_usage = 0
-            start_key_index = -1
+            duration = interval['end'] - interval['start']
+            usage_limit = max_usage - interval['usage']
 
-            for index, key in enumerate(usage_keys):
-                if key > interval['start']:
-                    break
-                start_key_index = index
-                start_usage += usage_changes[key]
+            # Usage at the (current) start of this interval:
+            original_start = start_key = interval['start']
+            start_usage = usage_index.usage(start_key)
 
             failed = False
             finished = False
             while not failed and not finished:
-                parallel_usage = 0
-                parallel_current = 0
-                for index in range(start_key_index+1, len(usage_keys)):
-                    key = usage_keys[index]
-                    if key >= interval['end']:
-                        break
-                    parallel_current += usage_changes[key]
-                    parallel_usage = max(parallel_usage, parallel_current)
+                parallel_usage = usage_index.peak(start_key, interval['end'])
+                parallel_usage = 0 if parallel_usage is None else max(0, parallel_usage - start_usage)
 
                 if start_usage + parallel_usage + interval['usage'] <= max_usage:
-
-                    start = interval['start']
-                    end = interval['end']
-                    if start not in usage_changes:
-                        usage_changes[start] = 0
-                    if end not in usage_changes:
-                        usage_changes[end] = 0
-
-                    usage_changes[start] += interval['usage']
-                    usage_changes[end] -= interval['usage']
+                    usage_index.add_interval(interval['start'], interval['end'], interval['usage'])
                     finished = True
                 else:
+                    # Every option before the last overloaded moment in this period would overlap with it:
+                    overloaded = usage_index.last_above(start_key, start_key + duration, usage_limit)
+                    if overloaded is not None:
+                        start_key = overloaded
+
                     while not failed:
-                        # Shift this interval to next possibility
-                        start_key_index += 1
+                        # Shift this interval to next possibility (skipping all moments that are too busy)
+                        next_option = usage_index.first_below(start_key, usage_limit)
 
                         # No more options
-                        if start_key_index >= len(usage_keys):
+                        if next_option is None:
                             failed = True
                         else:
-                            next_option = usage_keys[start_key_index]
-                            next_change = usage_changes[next_option]
-                            start_usage += next_change
+                            start_key = next_option
+                            next_change = usage_index.delta(next_option)
+                            start_usage = usage_index.usage(next_option)
 
                             # Lower usage at this starting point:
                             if next_change < 0:
-                                skip_delay = False
-                                if options.min_runtime > 0:
-                                    # Try to determine how long we have been running at this point:
-                                    min_runtime_delta = datetime.timedelta(seconds=options.min_runtime)
-                                    temp_usage = 0
-                                    running_since = next_option
-                                    not_running_since = next_option
-                                    for temp_index in range(0, start_key_index):
-                                        temp_usage_key = usage_keys[temp_index]
-                                        if temp_usage < 0.01 and usage_changes[temp_usage_key] > 0 and temp_usage_key - not_running_since > datetime.timedelta(seconds=3):
-                                            running_since = temp_usage_key
-                                        temp_usage += usage_changes[temp_usage_key]
-                                        if temp_usage < 0.01 and usage_changes[temp_usage_key] < 0:
-                                            not_running_since = temp_usage_key
-                                    if next_option - running_since < min_runtime_delta:
-                                        skip_delay = True
-
-                                if skip_delay:
-                                    time_to_next = next_option - interval['start']
-                                else:
-                                    time_to_next = next_option + delay_delta - interval['start']
-
+                                time_to_next = _shifted_start(usage_index, next_option, delay_delta) - interval['start']
                                 interval['start'] += time_to_next
                                 interval['end'] += time_to_next
                                 break
 
             if failed:
+                # Leave it where shifting it along every moment with lower usage would have ended:
+                interval['start'] = original_start
+                interval['end'] = original_start + duration
+                last_option = usage_index.last_decrease(original_start)
+                if last_option is not None:
+                    interval['start'] = _shifted_start(usage_index, last_option, delay_delta)
+                    interval['end'] = interval['start'] + duration
+
                 logging.warning('Could not schedule %s.', interval['uid'])
                 interval['blocked'] = 'scheduler error'
 
@@ -299,8 +532,8 @@ def combined_schedule(start_time, end_time):
     if current_time < start_time:
         result = predicted_schedule(start_time, end_time)
     elif current_time > end_time:
-        result = [entry for entry in log.finished_runs() if start_time <= entry['start'] <= end_time or
-                                                            start_time <= entry['end'] <= end_time]
+        result = [entry.to_dict() for entry in log.runs_between(start_time, end_time) if not entry['active'] and
+                  (start_time <= entry['start'] <= end_time or start_time <= entry['end'] <= end_time)]
     else:
         result = log.finished_runs()
         result += log.active_runs()
@@ -311,9 +544,18 @@ def combined_schedule(start_time, end_time):
 
 
 class _Scheduler(Thread):
+    # Changes are tracked using the state version, this only makes sure the time window moves along:
+    CACHE_TIME = datetime.timedelta(hours=1)
+
+    # Maximum time to sleep (in seconds) to notice changes we are not notified about (like clock adjustments):
+    MAX_SLEEP = 60
+
     def __init__(self):
         super(_Scheduler, self).__init__()
         self.daemon = True
+        self._schedule = None
+        self._schedule_key = None
+        self._schedule_time = None
         #options.add_callback('scheduler_enabled', self._option_cb)
         options.add_callback('manual_mode', self._option_cb)
         options.add_callback('master_relay', self._option_cb)
@@ -340,20 +582,74 @@ class _Scheduler(Thread):
         rain = not options.manual_mode and (rain_blocks.block_end() > datetime.datetime.now() or
                                             inputs.rain_sensed())
         active = log.active_runs()
-        for entry in active:
-            ignore_rain = stations.get(entry['station']).ignore_rain
-            if entry['end'] > current_time and (not rain or ignore_rain) and not entry['blocked']:
-                stations.activate(entry['station'])
+        with stations.batch():
+            for entry in active:
+                ignore_rain = stations.get(entry['station']).ignore_rain
+                if entry['end'] > current_time and (not rain or ignore_rain) and not entry['blocked']:
+                    stations.activate(entry['station'])
 
+        rain_status = None
         while True:
+            version = state_version.value
             try:
-                self._check_schedule()
+                # All changes of the outputs are written at once:
+                with stations.batch():
+                    self._check_schedule()
+
+                # The station status also shows the rain sensor and rain delay, which change without a new state:
+                new_rain_status = (inputs.rain_sensed(), rain_blocks.seconds_left() > 0)
+                if new_rain_status != rain_status:
+                    if rain_status is not None:
+                        status_version.bump()
+                    rain_status = new_rain_status
+                timeout = 1 if options.rain_sensor_enabled else self.MAX_SLEEP  # We need to poll the rain sensor
+                next_event = self._next_event(datetime.datetime.now())
+                if next_event is not None:
+                    timeout = min(timeout, (next_event - datetime.datetime.now()).total_seconds())
             except Exception:
                 logging.warning('Scheduler error:\n' + traceback.format_exc())
-            time.sleep(1)
+                timeout = 1
+
+            # Sleep until something needs to happen or until something has changed:
+            state_version.wait(version, timeout)
+
+    def _cached_schedule(self, current_time):
+        """Returns the predicted schedule from a day ago until a day from now.
+        The schedule is only recalculated if something changed or if the cached schedule is too old."""
+        cache_key = (state_version.value, inputs.rain_sensed())
+        if self._schedule is None or self._schedule_key != cache_key or \
+                not self._schedule_time <= current_time < self._schedule_time + self.CACHE_TIME:
+            self._schedule = predicted_schedule(current_time - datetime.timedelta(days=1),
+                                                current_time + datetime.timedelta(days=1))
+            self._schedule_key = cache_key
+            self._schedule_time = current_time
+        return self._schedule
+
+    def _next_event(self, current_time):
+        """Returns the first moment after the current time at which outputs might need to change.
+        Returns None if no such moment is known."""
+        runs = log.active_runs()
+        moments = [rain_blocks.block_end()]
+        if not options.manual_mode:
+            runs += self._cached_schedule(current_time)
+            moments.append(self._schedule_time + self.CACHE_TIME)
 
-    @staticmethod
-    def _check_schedule():
+        master_delays = (stations.master is not None or options.master_relay) and \
+                        not options.master_on_delay == options.master_off_delay == 0
+        if master_delays:
+            runs += log.finished_runs()
+        on_delay = datetime.timedelta(seconds=options.master_on_delay)
+        off_delay = datetime.timedelta(seconds=options.master_off_delay)
+
+        for entry in runs:
+            moments += [entry['start'], entry['end']]
+            if master_delays:
+                moments += [entry['start'] + on_delay, entry['end'] + off_delay]
+
+        moments = [moment for moment in moments if moment > current_time]
+        return min(moments) if moments else None
+
+    def _check_schedule(self):
         current_time = datetime.datetime.now()
         check_start = current_time - datetime.timedelta(days=1)
         check_end = current_time + datetime.timedelta(days=1)
@@ -370,7 +666,7 @@ class _Scheduler(Thread):
                     stations.deactivate(entry['station'])
 
         if not options.manual_mode:
-            schedule = predicted_schedule(check_start, check_end)
+            schedule = self._cached_schedule(current_time)
             #import pprint
             #logging.debug("Schedule: %s", pprint.pformat(schedule))
             for entry in schedule:
@@ -394,7 +690,9 @@ class _Scheduler(Thread):
                 if options.manual_mode:
                     active = log.finished_runs() + active
                 else:
-                    active = combined_schedule(check_start, check_end)
+                    active = log.finished_runs() + log.active_runs()
+                    active += [entry for entry in self._cached_schedule(current_time)
+                               if current_time <= entry['start'] <= check_end]
 
                 for entry in active:
                     if not entry['blocked'] and stations.get(entry['station']).activate_master:
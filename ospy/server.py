@@ -8,6 +8,7 @@ import shelve
 import web
 import os
 import glob
+import logging
 
 # Local imports
 from ospy.options import options
@@ -26,6 +27,9 @@ class DebugLogMiddleware:
         self.format = '%s "%s %s %s" - %s'
 
     def __call__(self, environ, start_response):
+        if not options.debug_log:  # The root logger always passes debug messages on to our log handler
+            return self.app(environ, start_response)
+
         def xstart_response(status, response_headers, *args):
             out = start_response(status, response_headers, *args)
             self.log(status, environ)
@@ -34,8 +38,6 @@ class DebugLogMiddleware:
         return self.app(environ, xstart_response)
 
     def log(self, status, environ):
-        import logging
-
         req = environ.get('PATH_INFO', '_')
         protocol = environ.get('ACTUAL_SERVER_PROTOCOL', '-')
         method = environ.get('REQUEST_METHOD', '-')
@@ -61,6 +63,16 @@ class PluginStaticMiddleware(web.httpserver.StaticMiddleware):
             return self.app(environ, start_response)
 
 
+def _create_server(wsgifunc):
+    """Creates the web server, using the number of worker threads and keep-alive timeout of the options."""
+    server = web.httpserver.WSGIServer(("0.0.0.0", options.web_port), wsgifunc)
+    server.requests.min = options.web_threads
+    server.request_queue_size = max(5, options.web_threads)  # Connections waiting to be accepted
+    server.timeout = options.web_keep_alive  # Also limits waiting for the rest of a request
+    server.shutdown_timeout = 1  # Speed-up restarting
+    return server
+
+
 def start():
     global __server
     global session
@@ -71,6 +83,7 @@ def start():
     web.config.debug = False  # Improves page load speed', ]
 
     from ospy.urls import urls
+    import ospy.webpages  # Loads all templates before the first request instead of on the first request
     app = web.application(urls, globals())
     app.notfound = lambda: web.seeother('/', True)
 
@@ -78,8 +91,7 @@ def start():
     wsgifunc = web.httpserver.StaticMiddleware(wsgifunc)
     wsgifunc = PluginStaticMiddleware(wsgifunc)
     wsgifunc = DebugLogMiddleware(wsgifunc)
-    __server = web.httpserver.WSGIServer(("0.0.0.0", options.web_port), wsgifunc)
-    __server.timeout = 1  # Speed-up restarting
+    __server = _create_server(wsgifunc)
 
     sessions = None
     try:
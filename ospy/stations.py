@@ -3,18 +3,27 @@
 __author__ = 'Rimco'
 
 # System imports
+from contextlib import contextmanager
 import datetime
 import logging
+import os
+import stat
+import struct
+import threading
+import traceback
 
 # Local imports
-from ospy.options import options
+from ospy import gpio
+from ospy.options import options, status_version
 
 
 class _Station(object):
-    SAVE_EXCLUDE = ['SAVE_EXCLUDE', 'index', 'is_master', 'active', 'remaining_seconds']
+    SAVE_FIELDS = ['activate_master', 'balance', 'capacity', 'enabled', 'eto_factor', 'ignore_rain', 'name',
+                   'precipitation', 'usage']
 
     def __init__(self, stations_instance, index):
         self._stations = stations_instance
+        self._index = None  # Assigned by the stations instance once this station is part of it
         self.activate_master = False
 
         self.name = "Station %02d" % (index+1)
@@ -48,7 +57,9 @@ class _Station(object):
 
     @property
     def index(self):
-        return self._stations.get().index(self)
+        if self._index is None:
+            raise ValueError('Station is not part of the stations')
+        return self._index
 
     @property
     def is_master(self):
@@ -78,11 +89,9 @@ class _Station(object):
         Returns 0 if no corresponding interval was found.
         Returns -1 if it should be considered infinite."""
         from ospy.log import log
-        active = log.active_runs()
-        index = self.index
         result = 0
-        for interval in active:
-            if not interval['blocked'] and interval['station'] == index:
+        for interval in log.active_runs_for_station(self.index):
+            if not interval['blocked']:
                 result = max(0, (interval['end'] - datetime.datetime.now()).total_seconds())
                 if result > datetime.timedelta(days=356).total_seconds():
                     result = -1
@@ -92,8 +101,8 @@ class _Station(object):
     def __setattr__(self, key, value):
         try:
             super(_Station, self).__setattr__(key, value)
-            if not key.startswith('_') and key not in self.SAVE_EXCLUDE:
-                options.save(self, self.index)
+            if key in self.SAVE_FIELDS:
+                self._stations._save_station(self)
         except ValueError:  # No index available yet
             pass
 
@@ -102,7 +111,93 @@ class _Station(object):
                             'scheduling it will be impossible.', self.name)
 
 
+class _StationState(object):
+    """The on/off state of all outputs, packed as one bit per output (output i is bit i % 8 of byte i // 8).
+    Bits beyond the number of outputs are always cleared."""
+    __slots__ = ('_bits', '_count')
+
+    def __init__(self, count=0):
+        self._bits = bytearray((count + 7) // 8)
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return bool(self._bits[index >> 3] & (1 << (index & 7)))
+
+    def __setitem__(self, index, value):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        if value:
+            self._bits[index >> 3] |= 1 << (index & 7)
+        else:
+            self._bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield bool(self._bits[index >> 3] & (1 << (index & 7)))
+
+    def __reversed__(self):
+        for index in reversed(range(self._count)):
+            yield bool(self._bits[index >> 3] & (1 << (index & 7)))
+
+    def __eq__(self, other):
+        return isinstance(other, _StationState) and self._count == other._count and self._bits == other._bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def copy(self):
+        result = _StationState()
+        result._bits = bytearray(self._bits)
+        result._count = self._count
+        return result
+
+    def resize(self, count):
+        self._bits[(count + 7) // 8:] = b''
+        self._bits.extend(bytearray((count + 7) // 8 - len(self._bits)))
+        if count % 8 and count < self._count:
+            self._bits[-1] &= (1 << (count % 8)) - 1
+        self._count = count
+
+    def clear(self):
+        self._bits[:] = bytearray(len(self._bits))
+
+    def active_indices(self):
+        """Returns the indices of all active outputs, skipping inactive bytes at once."""
+        result = []
+        for byte_index, byte in enumerate(self._bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        result.append(byte_index * 8 + bit)
+        return result
+
+    def diff(self, other):
+        """Returns the indices of all outputs that differ from the other state (which should have the same size)."""
+        result = []
+        for byte_index, (byte, other_byte) in enumerate(zip(self._bits, other._bits)):
+            changed = byte ^ other_byte
+            if changed:
+                for bit in range(8):
+                    if changed & (1 << bit):
+                        result.append(byte_index * 8 + bit)
+        return result
+
+    def shift_bytes(self):
+        """Returns the packed bytes in the order they should be shifted out to a chain of shift registers:
+        the last output first, padded at the start to whole bytes and most significant bit first."""
+        return bytes(self._bits[::-1])
+
+
 class _BaseStations(object):
+    SAVE_FIELDS = ['master']
+
     def __init__(self, count):
         self._loading = True
         self.master = None
@@ -110,9 +205,14 @@ class _BaseStations(object):
         self._loading = False
 
         self._stations = []
-        self._state = [False] * count
+        self._state = _StationState(count)
+        self._written_state = None  # The state the real outputs were last updated to
+        self._batch_depth = 0
+        self._batch_lock = threading.Lock()
+        self._edit_depth = 0
+        self._edited = set()  # Indices of the stations changed during an edit
         for i in range(count):
-            self._stations.append(_Station(self, i))
+            self._add_station()
         self.clear()
 
         options.add_callback('output_count', self._resize_cb)
@@ -121,13 +221,65 @@ class _BaseStations(object):
         """This function should be used to update real outputs according to self._state."""
         logging.debug("Activated outputs")
 
+    def _flush(self, force=False):
+        """Updates the real outputs if the state has changed since the last update.
+        While a batch is in progress this is postponed until the end of the batch, unless forced."""
+        if (force or self._batch_depth == 0) and self._state != self._written_state:
+            self._activate()
+            self._written_state = self._state.copy()
+
+    @contextmanager
+    def batch(self):
+        """Collects all changes made within the with-statement and updates the real outputs only once."""
+        with self._batch_lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._batch_lock:
+                self._batch_depth -= 1
+            self._flush()
+
+    def _save_station(self, station):
+        if self._edit_depth > 0:
+            with self._batch_lock:
+                self._edited.add(station.index)
+        else:
+            options.save(station, station.index)
+
+    @contextmanager
+    def edit(self):
+        """Saves the stations changed within the with-statement only once at the end of it,
+        instead of after every change of an attribute."""
+        with options.batch():
+            with self._batch_lock:
+                self._edit_depth += 1
+            try:
+                yield self
+            finally:
+                with self._batch_lock:
+                    self._edit_depth -= 1
+                    edited = []
+                    if self._edit_depth == 0:
+                        edited = sorted(self._edited)
+                        self._edited.clear()
+                for index in edited:
+                    if index < len(self._stations):
+                        options.save(self._stations[index], index)
+
+    def _add_station(self):
+        station = _Station(self, len(self._stations))
+        self._stations.append(station)
+        station._index = len(self._stations) - 1
+
     def _resize_cb(self, key, old, new):
         self.resize(new)
 
     def resize(self, count):
         while len(self._stations) < count:
-            self._stations.append(_Station(self, len(self._stations)))
-            self._state.append(False)
+            self._add_station()
+        if count > len(self._state):
+            self._state.resize(count)
 
         if count < len(self._stations):
             if self.master >= count:
@@ -136,11 +288,11 @@ class _BaseStations(object):
             # Make sure we turn them off before they become unreachable
             for index in range(count, len(self._stations)):
                 self._state[index] = False
-            self._activate()
+            self._flush(True)
 
             while len(self._stations) > count:
-                del self._stations[-1]
-                del self._state[-1]
+                self._stations.pop()._index = None
+            self._state.resize(count)
 
         logging.debug("Resized to %d", count)
 
@@ -162,34 +314,47 @@ class _BaseStations(object):
     def activate(self, index):
         if not isinstance(index, list):
             index = [index]
+        changed = False
         for i in index:
             if i < len(self._state):
+                changed = changed or not self._state[i]
                 self._state[i] = True
                 logging.debug("Activated output %d", i)
+        if changed:
+            status_version.bump()
 
     def deactivate(self, index):
         if not isinstance(index, list):
             index = [index]
+        changed = False
         for i in index:
             if i < len(self._state):
+                changed = changed or self._state[i]
                 self._state[i] = False
                 logging.debug("Deactivated output %d", i)
+        if changed:
+            status_version.bump()
 
     def active(self, index=None):
         if index is None:
-            result = self._state[:]
+            result = list(self._state)
         else:
             result = self._state[index] if index < len(self._state) else False
         return result
 
+    def active_indices(self):
+        return self._state.active_indices()
+
     def clear(self):
-        for i in range(len(self._state)):
-            self._state[i] = False
+        changed = bool(self._state.active_indices())
+        self._state.clear()
         logging.debug("Cleared all outputs")
+        if changed:
+            status_version.bump()
 
     def __setattr__(self, key, value):
         super(_BaseStations, self).__setattr__(key, value)
-        if not key.startswith('_') and not self._loading:
+        if key in self.SAVE_FIELDS and not self._loading:
             options.save(self)
 
 
@@ -203,6 +368,10 @@ class _ShiftStations(_BaseStations):
     _sr_lat = 0
 
     def __init__(self, count):
+        self._setup_io()
+        super(_ShiftStations, self).__init__(count)
+
+    def _setup_io(self):
         self._io.setup(self._sr_noe, self._io.OUT)
         self._io.output(self._sr_noe, self._io.HIGH)
         self._io.setup(self._sr_clk, self._io.OUT)
@@ -212,8 +381,6 @@ class _ShiftStations(_BaseStations):
         self._io.setup(self._sr_lat, self._io.OUT)
         self._io.output(self._sr_lat, self._io.LOW)
 
-        super(_ShiftStations, self).__init__(count)
-
     def _activate(self):
         """Set the state of each output pin on the shift register from the internal state."""
         self._io.output(self._sr_noe, self._io.HIGH)
@@ -229,27 +396,24 @@ class _ShiftStations(_BaseStations):
 
     def resize(self, count):
         super(_ShiftStations, self).resize(count)
-        self._activate()
+        self._flush()
 
     def activate(self, index):
         super(_ShiftStations, self).activate(index)
-        self._activate()
+        self._flush()
 
     def deactivate(self, index):
         super(_ShiftStations, self).deactivate(index)
-        self._activate()
+        self._flush()
 
     def clear(self):
         super(_ShiftStations, self).clear()
-        self._activate()
+        self._flush()
 
 
 class _RPiStations(_ShiftStations):
     def __init__(self, count):
-        import RPi.GPIO as GPIO  # RPi hardware
-        self._io = GPIO
-        self._io.setwarnings(False)
-        self._io.setmode(self._io.BOARD)  # IO channels are identified by header connector pin numbers. Pin numbers are always the same regardless of Raspberry Pi board revision.
+        self._io = gpio.rpi()
 
         self._sr_dat = 13
         self._sr_clk = 7
@@ -261,9 +425,7 @@ class _RPiStations(_ShiftStations):
 
 class _BBBStations(_ShiftStations):
     def __init__(self, count):
-        import Adafruit_BBIO.GPIO as GPIO  # Beagle Bone Black hardware
-        self._io = GPIO
-        self._io.setwarnings(False)
+        self._io = gpio.bbb()
 
         self._sr_dat = "P9_11"
         self._sr_clk = "P9_13"
@@ -272,12 +434,75 @@ class _BBBStations(_ShiftStations):
 
         super(_BBBStations, self).__init__(count)
 
-try:
-    stations = _RPiStations(options.output_count)
-except Exception as err:
-    logging.debug(err)
+
+class _SimulatedStations(_ShiftStations):
+    """Shift register stations using the simulated GPIO (wired like a Raspberry Pi)."""
+    def __init__(self, count):
+        self._io = gpio.simulated()
+
+        self._sr_dat = 13
+        self._sr_clk = 7
+        self._sr_noe = 11
+        self._sr_lat = 15
+        self._register = self._io.shift_register(self._sr_dat, self._sr_clk, self._sr_lat)
+
+        super(_SimulatedStations, self).__init__(count)
+
+class _SPIStations(_ShiftStations):
+    """Shift register stations driven by the SPI interface (MOSI to DAT, SCLK to CLK and CE0 to LAT).
+    The complete state is written in a single transfer instead of toggling pins for every bit.
+    The device can also be an existing regular file (which will contain the last transfer) for testing."""
+    SPEED = 1000000  # Hz
+    _SPI_IOC_WR_MAX_SPEED_HZ = 0x40046b04
+
+    def __init__(self, count, device):
+        self._fd = os.open(device, os.O_WRONLY)  # Never create it, a missing device means SPI is not enabled
+        try:
+            self._is_device = stat.S_ISCHR(os.fstat(self._fd).st_mode)
+            if self._is_device:
+                import fcntl
+                fcntl.ioctl(self._fd, self._SPI_IOC_WR_MAX_SPEED_HZ, struct.pack('I', self.SPEED))
+                self._io = gpio.rpi()
+            else:
+                self._io = gpio.simulated()
+        except Exception:
+            os.close(self._fd)
+            raise
+
+        self._sr_noe = 11
+
+        super(_SPIStations, self).__init__(count)
+
+    def _setup_io(self):
+        self._io.setup(self._sr_noe, self._io.OUT)
+        self._io.output(self._sr_noe, self._io.HIGH)
+
+    def _activate(self):
+        data = self._state.shift_bytes()
+        if not self._is_device:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, data)
+        if not self._is_device:
+            os.ftruncate(self._fd, len(data))
+        self._io.output(self._sr_noe, self._io.LOW)
+        logging.debug("Activated SPI outputs")
+
+if options.gpio_backend == 'simulated':
+    stations = _SimulatedStations(options.output_count)
+elif options.gpio_backend == 'spi':
+    try:
+        stations = _SPIStations(options.output_count, options.spi_device)
+    except Exception:
+        logging.error('Could not use SPI device %s, outputs will not be switched:\n%s',
+                      options.spi_device, traceback.format_exc())
+        stations = _BaseStations(options.output_count)
+else:
     try:
-        stations = _BBBStations(options.output_count)
+        stations = _RPiStations(options.output_count)
     except Exception as err:
         logging.debug(err)
-        stations = _BaseStations(options.output_count)
\ No newline at end of file
+        try:
+            stations = _BBBStations(options.output_count)
+        except Exception as err:
+            logging.debug(err)
+            stations = _BaseStations(options.output_count)
\ No newline at end of file
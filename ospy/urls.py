@@ -27,6 +27,7 @@ urls = [
     '/help', 'ospy.webpages.help_page',
 
     '/status.json', 'ospy.webpages.api_status_json',
+    '/status.events', 'ospy.webpages.api_status_events',
     '/log.json', 'ospy.webpages.api_log_json',
     '/balance.json', 'ospy.webpages.api_balance_json',
 
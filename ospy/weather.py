@@ -17,43 +17,156 @@ else:
 
 import json
 import datetime
+import os
+import re
 import time
 import math
+from collections import OrderedDict
 from threading import Thread, Lock
 
+try:
+    import numpy  # Optional, used to calculate the weather results of many days at once
+except ImportError:
+    numpy = None
+
+from ospy.helpers import mkdir_p
 from ospy.options import options
 
+WEATHER_CACHE_DIR = './ospy/data/weather'
+
+
+class _ScalarMath(object):
+    """The NumPy functions used by the ETo calculation for single values, used if NumPy is not available."""
+    exp = staticmethod(math.exp)
+    sqrt = staticmethod(math.sqrt)
+    power = staticmethod(math.pow)
+    sin = staticmethod(math.sin)
+    cos = staticmethod(math.cos)
+    radians = staticmethod(math.radians)
+    maximum = staticmethod(max)
+
+    @staticmethod
+    def clip(value, minimum, maximum):
+        return min(max(value, minimum), maximum)
+
+
+class _WeatherCache(object):
+    """Stores weather results on disk, using a separate file for each date.
+    Files are only read when their date is needed. Dates older than MAX_AGE days are removed,
+    as are the oldest dates if all files together are larger than MAX_SIZE bytes."""
+    MAX_AGE = 30
+    MAX_SIZE = 8*1024*1024
+    FILE_NAME = re.compile(r'^(\d{4})-(\d{2})-(\d{2})\.json$')
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._lock = Lock()
+        self._location = None  # The location and elevation the stored results belong to
+        self._dates = {}  # date -> {cache_name: value} for all dates that have been read
+
+    def _path(self, name):
+        return os.path.join(self._directory, name)
+
+    def _date_path(self, check_date):
+        return self._path(check_date.strftime('%Y-%m-%d') + '.json')
+
+    def _read(self, name, default):
+        try:
+            with open(self._path(name)) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return default
+
+    def _write(self, name, data):
+        mkdir_p(self._directory)
+        with open(self._path(name) + '.tmp', 'w') as fh:
+            json.dump(data, fh)
+        if os.path.exists(self._path(name)):
+            os.remove(self._path(name))  # Windows cannot rename onto an existing file
+        os.rename(self._path(name) + '.tmp', self._path(name))
+
+    def _entries(self, check_date):
+        if check_date not in self._dates:
+            entries = self._read(os.path.basename(self._date_path(check_date)), {})
+            if 'darksky_data' in entries:
+                # UPGRADE: raw forecasts used to be stored as well
+                del entries['darksky_data']
+                self._write(os.path.basename(self._date_path(check_date)), entries)
+            self._dates[check_date] = entries
+        return self._dates[check_date]
+
+    def _stored_dates(self):
+        """Returns all dates that have a file, sorted from old to new."""
+        if not os.path.isdir(self._directory):
+            return []
+        return sorted(datetime.date(*[int(part) for part in match.groups()]) for match in
+                      (self.FILE_NAME.match(name) for name in os.listdir(self._directory)) if match)
+
+    def _evict(self):
+        oldest = datetime.date.today() - datetime.timedelta(days=self.MAX_AGE)
+        dates = self._stored_dates()
+        sizes = [os.path.getsize(self._date_path(stored_date)) for stored_date in dates]
+        total = sum(sizes)
+        for stored_date, size in zip(dates, sizes):
+            if stored_date >= oldest and total <= self.MAX_SIZE:
+                break
+            os.remove(self._date_path(stored_date))
+            self._dates.pop(stored_date, None)
+            total -= size
+
+    def use_location(self, location, elevation):
+        """Clears the cache if it was filled for a different location or elevation."""
+        with self._lock:
+            settings = {'location': location, 'elevation': elevation}
+            if self._location is None:
+                self._location = self._read('location.json', None)
+            if self._location != settings:
+                for stored_date in self._stored_dates():
+                    os.remove(self._date_path(stored_date))
+                self._dates = {}
+                self._write('location.json', settings)
+                self._location = settings
+
+    def contains(self, cache_name, check_date):
+        with self._lock:
+            return cache_name in self._entries(check_date)
+
+    def get(self, cache_name, check_date):
+        with self._lock:
+            return self._entries(check_date)[cache_name]
+
+    def set(self, cache_name, check_date, value):
+        with self._lock:
+            entries = self._entries(check_date)
+            if cache_name not in entries or entries[cache_name] != value:
+                entries[cache_name] = value
+                self._write(os.path.basename(self._date_path(check_date)), entries)
+                self._evict()
+
 
 def _cache(cache_name):
     def cache_decorator(func):
         def func_wrapper(self, check_date):
-            if 'location' not in self._result_cache or options.location != self._result_cache['location'] or \
-                    'elevation' not in self._result_cache or options.elevation != self._result_cache['elevation']:
-                self._result_cache = {
-                    'location': options.location,
-                    'elevation': options.elevation
-                }
-            if cache_name not in self._result_cache:
-                self._result_cache[cache_name] = {}
-
-            for key in list(self._result_cache[cache_name].keys()):
-                if (datetime.date.today() - key).days > 30:
-                    del self._result_cache[cache_name][key]
-
-            if check_date not in self._result_cache[cache_name] or (datetime.date.today() - check_date).days <= 1:
+            if isinstance(check_date, datetime.datetime):
+                check_date = check_date.date()
+
+            self._result_cache.use_location(options.location, options.elevation)
+
+            if (datetime.date.today() - check_date).days <= 1 or not self._result_cache.contains(cache_name, check_date):
                 try:
-                    self._result_cache[cache_name][check_date] = func(self, check_date)
-                    options.weather_cache = self._result_cache
+                    self._result_cache.set(cache_name, check_date, func(self, check_date))
                 except Exception:
-                    if check_date not in self._result_cache[cache_name]:
+                    if not self._result_cache.contains(cache_name, check_date):
                         raise
 
-            return self._result_cache[cache_name][check_date]
+            return self._result_cache.get(cache_name, check_date)
         return func_wrapper
     return cache_decorator
 
 
 class _Weather(Thread):
+    MAX_INDICES = 64  # Number of forecasts for which the records grouped by date are kept
+
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
@@ -65,7 +178,19 @@ class _Weather(Thread):
         self._lon = None
         self._tz_offset = 0
         self._determine_location = True
-        self._result_cache = options.weather_cache
+        self._result_cache = _WeatherCache(WEATHER_CACHE_DIR)
+        self._json_cache = {}  # Short term cache of the raw forecasts, only kept in memory
+        self._indices = OrderedDict()  # Records of recently used forecasts grouped by date
+
+        if 'weather_cache' in options:
+            # UPGRADE: results used to be stored in the options
+            if options.weather_cache.get('location') == options.location and \
+                    options.weather_cache.get('elevation') == options.elevation:
+                self._result_cache.use_location(options.location, options.elevation)
+                for cache_name in ['eto', 'rain']:
+                    for check_date, value in options.weather_cache.get(cache_name, {}).items():
+                        self._result_cache.set(cache_name, check_date, value)
+            del options.weather_cache
 
         options.add_callback('location', self._option_cb)
         options.add_callback('darksky_key', self._option_cb)
@@ -135,7 +260,6 @@ class _Weather(Thread):
             raise Exception('No location coordinates available!')
         return self._lat, self._lon
 
-    @_cache('darksky_data')
     def _get_darksky_data(self, check_date):
         #logging.debug("getting weather")
         if isinstance(check_date, datetime.datetime):
@@ -148,59 +272,74 @@ class _Weather(Thread):
         url = "https://api.openweathermap.org/data/2.5/onecall?lat=%s&lon=%s&exclude=minutely,alerts&appid=%s" % (  self.get_lat_lon()  + (options.darksky_key,))
         #print("we did it")
         # We cache results for previous days, but we also want to have a short term cache for predictions:
-        if 'darksky_json' not in self._result_cache:
-            self._result_cache['darksky_json'] = {}
-
-        for key in list(self._result_cache['darksky_json'].keys()):
-            if datetime.datetime.now() - self._result_cache['darksky_json'][key]['dt'] > datetime.timedelta(minutes=10):
-                del self._result_cache['darksky_json'][key]
+        for key in list(self._json_cache.keys()):
+            if datetime.datetime.now() - self._json_cache[key]['dt'] > datetime.timedelta(minutes=10):
+                del self._json_cache[key]
 
-        if url not in self._result_cache['darksky_json']:
+        if url not in self._json_cache:
             logging.debug(url)
             data = urlopen(url)
-            self._result_cache['darksky_json'][url] = {'dt': datetime.datetime.now(),
-                                                       'data': json.loads(data.read().decode(data.info().get_content_charset('utf-8')))}
-            options.weather_cache = self._result_cache
+            self._json_cache[url] = {'dt': datetime.datetime.now(),
+                                     'data': json.loads(data.read().decode(data.info().get_content_charset('utf-8')))}
+            self._forecast_index(self._json_cache[url]['data'])
 
-        if 'offset' in self._result_cache['darksky_json'][url]['data']:
-            self._tz_offset = self._result_cache['darksky_json'][url]['data']['offset']
+        if 'offset' in self._json_cache[url]['data']:
+            self._tz_offset = self._json_cache[url]['data']['offset']
         elif self._tz_offset == 0:
             logging.warning('No timezone offset found, ETo might be incorrect.')
 
-        return self._result_cache['darksky_json'][url]['data']
+        return self._json_cache[url]['data']
+
+    def _forecast_index(self, data):
+        """Returns {'hourly': {date: [records]}, 'daily': {date: record}} for the given forecast.
+        The records are only grouped once for every forecast."""
+        with self._lock:
+            key = id(data)
+            if key in self._indices and self._indices[key][0] is data:
+                entry = self._indices.pop(key)
+            else:
+                index = {}
+                if 'hourly' in data:
+                    index['hourly'] = {}
+                    for x in data['hourly']:
+                        index['hourly'].setdefault(datetime.datetime.fromtimestamp(x['dt']).date(), []).append(x)
+                if 'daily' in data:
+                    index['daily'] = {}
+                    for x in data['daily']:
+                        index['daily'].setdefault(datetime.datetime.fromtimestamp(x['dt']).date(), x)
+                entry = (data, index)  # Keep a reference to the data to make sure its id isn't reused
+
+            self._indices[key] = entry
+            while len(self._indices) > self.MAX_INDICES:
+                self._indices.popitem(last=False)
+            return entry[1]
 
     def get_hourly_data(self, check_date):
         if isinstance(check_date, datetime.datetime):
             check_date = check_date.date()
-        #print(self._get_darksky_data(check_date))
-        return [x for x in self._get_darksky_data(check_date)['hourly'] if datetime.datetime.fromtimestamp(x['dt']).date() == check_date]
+        return list(self._forecast_index(self._get_darksky_data(check_date))['hourly'].get(check_date, []))
 
     def get_daily_data(self, check_date):
         if isinstance(check_date, datetime.datetime):
             check_date = check_date.date()
-
-        matching_days_data = [x for x in self._get_darksky_data(check_date)['daily'] if datetime.datetime.fromtimestamp(x['dt']).date() == check_date]
-
-        return matching_days_data[0] if matching_days_data else {}
+        return self._forecast_index(self._get_darksky_data(check_date))['daily'].get(check_date, {})
 
     def get_current_data(self):
         return self._get_darksky_data(datetime.date.today() + datetime.timedelta(days=1))['currently']
 
-    def _calc_radiation(self, coverage, fractional_day, local_hour):
+    def _calc_radiation(self, coverage, fractional_day, local_hour, xp=_ScalarMath):
+        """Returns the solar radiation and clear sky isolation, for single hours or for arrays of hours (xp=numpy)."""
         gmt_hour = local_hour - self._tz_offset
-        f = math.radians(fractional_day)
-        declination = 0.396372 - 22.91327 * math.cos(f) + 4.02543  * math.sin(f) - 0.387205 * math.cos(2*f) + 0.051967 * math.sin(2*f) - 0.154527 * math.cos(3*f) + 0.084798 * math.sin(3*f)
-        time_correction = 0.004297 + 0.107029 * math.cos(f) - 1.837877 * math.sin(f) - 0.837378 * math.cos(2*f) - 2.340475 * math.sin(2*f)
+        f = xp.radians(fractional_day)
+        declination = 0.396372 - 22.91327 * xp.cos(f) + 4.02543  * xp.sin(f) - 0.387205 * xp.cos(2*f) + 0.051967 * xp.sin(2*f) - 0.154527 * xp.cos(3*f) + 0.084798 * xp.sin(3*f)
+        time_correction = 0.004297 + 0.107029 * xp.cos(f) - 1.837877 * xp.sin(f) - 0.837378 * xp.cos(2*f) - 2.340475 * xp.sin(2*f)
         solar_hour = (gmt_hour + 0.5 - 12)*15 + self._lon + time_correction
 
-        if solar_hour < -180: solar_hour += 360
-        if solar_hour > 180: solar_hour -= 360
+        # The sine of the elevation of the sun
+        solar_factor = xp.clip(math.sin(math.radians(self._lat))*xp.sin(xp.radians(declination))+math.cos(math.radians(self._lat))*xp.cos(xp.radians(declination))*xp.cos(xp.radians(solar_hour)), -1, 1)
 
-        solar_factor = math.sin(math.radians(self._lat))*math.sin(math.radians(declination))+math.cos(math.radians(self._lat))*math.cos(math.radians(declination))*math.cos(math.radians(solar_hour))
-        sun_elevation = math.degrees(math.asin(solar_factor))
-
-        clear_sky_isolation = max(0, 990 * math.sin(math.radians(sun_elevation)) - 30)
-        solar_radiation = clear_sky_isolation * (1 - 0.75 * math.pow(coverage, 3.4))
+        clear_sky_isolation = xp.maximum(0, 990 * solar_factor - 30)
+        solar_radiation = clear_sky_isolation * (1 - 0.75 * xp.power(coverage, 3.4))
 
         return solar_radiation, clear_sky_isolation
 
@@ -214,6 +353,10 @@ class _Weather(Thread):
         if isinstance(check_date, datetime.datetime):
             check_date = check_date.date()
 
+        if numpy is not None:
+            return self._calc_eto_and_rain(self._get_darksky_data(check_date), [check_date])[0][0]
+
+        # Without NumPy, the same formulas are applied to the hours of this day one by one:
         hourly_data = self.get_hourly_data(check_date)
 
         total_solar_radiation = 0
@@ -246,6 +389,16 @@ class _Weather(Thread):
         temp_min = daily_data.get('temperatureMin', 20) # degrees C
         temp_max = daily_data.get('temperatureMax', 20) # degrees C
 
+        return self._calc_eto(_ScalarMath, total_solar_radiation, total_clear_sky_isolation, temp_avg, humid_min,
+                              humid_max, wind_speed, pressure, temp_min, temp_max)
+
+    @staticmethod
+    def _calc_eto(xp, total_solar_radiation, total_clear_sky_isolation, temp_avg, humid_min, humid_max,
+                  wind_speed, pressure, temp_min, temp_max):
+        """Penman-Monteith ETo for single days or for arrays of days (xp=numpy)."""
+        def saturation_vapour_pressure(t):
+            return 0.6108 * xp.exp((17.27 * t) / (t + 237.3))
+
         # Solar Radiation
         r_s = total_solar_radiation * 3600 / 1000 / 1000 # MJ / m^2 / d
         # Net shortwave radiation
@@ -256,20 +409,20 @@ class _Weather(Thread):
         # Clear sky solar radiation
         r_so = (0.75 + 0.00002 * options.elevation) * r_a
 
-        sigma_t_max4 = 0.000000004903 * math.pow(temp_max + 273.16, 4)
-        sigma_t_min4 = 0.000000004903 * math.pow(temp_min + 273.16, 4)
+        sigma_t_max4 = 0.000000004903 * xp.power(temp_max + 273.16, 4)
+        sigma_t_min4 = 0.000000004903 * xp.power(temp_min + 273.16, 4)
         avg_sigma_t = (sigma_t_max4 + sigma_t_min4) / 2
 
-        d = 4098 * _Weather.saturation_vapour_pressure(temp_avg) / math.pow(temp_avg + 237.3, 2)
+        d = 4098 * saturation_vapour_pressure(temp_avg) / xp.power(temp_avg + 237.3, 2)
         g = 0.665e-3 * pressure
 
-        es = (_Weather.saturation_vapour_pressure(temp_min) + _Weather.saturation_vapour_pressure(temp_max)) / 2
-        ea = _Weather.saturation_vapour_pressure(temp_min) * humid_max / 200 + _Weather.saturation_vapour_pressure(temp_max) * humid_min / 200
+        es = (saturation_vapour_pressure(temp_min) + saturation_vapour_pressure(temp_max)) / 2
+        ea = saturation_vapour_pressure(temp_min) * humid_max / 200 + saturation_vapour_pressure(temp_max) * humid_min / 200
 
         vapor_press_deficit = es - ea
 
         # Net longwave radiation
-        r_nl = avg_sigma_t * (0.34 - 0.14 * math.sqrt(ea)) * (1.35 * r_s / max(1, r_so) - 0.35)
+        r_nl = avg_sigma_t * (0.34 - 0.14 * xp.sqrt(ea)) * (1.35 * r_s / xp.maximum(1, r_so) - 0.35)
         # Net radiation
         r_n = r_ns - r_nl
 
@@ -277,6 +430,115 @@ class _Weather(Thread):
 
         return eto
 
+    def get_eto_and_rain(self, check_dates):
+        """Returns {date: (eto, rain)} for all given dates, leaving out the dates for which no
+        weather information could be found. Results are cached in the same way as get_eto and get_rain.
+        If NumPy is available, all dates using the same forecast are calculated at once."""
+        result = {}
+        failed = []
+        if numpy is None:
+            for check_date in check_dates:
+                try:
+                    result[check_date] = (self.get_eto(check_date), self.get_rain(check_date))
+                except Exception:
+                    failed.append((check_date, traceback.format_exc()))
+        else:
+            self._result_cache.use_location(options.location, options.elevation)
+
+            forecasts = {}
+            for check_date in check_dates:
+                if (datetime.date.today() - check_date).days <= 1 or \
+                        not self._result_cache.contains('eto', check_date) or \
+                        not self._result_cache.contains('rain', check_date):
+                    try:
+                        data = self._get_darksky_data(check_date)
+                        forecasts.setdefault(id(data), (data, []))[1].append(check_date)
+                    except Exception:
+                        failed.append((check_date, traceback.format_exc()))
+
+            for data, dates in forecasts.values():
+                try:
+                    for check_date, eto, rain in zip(dates, *self._calc_eto_and_rain(data, dates)):
+                        self._result_cache.set('eto', check_date, eto)
+                        self._result_cache.set('rain', check_date, rain)
+                except Exception:
+                    failed.extend((check_date, traceback.format_exc()) for check_date in dates)
+
+            for check_date in check_dates:
+                if self._result_cache.contains('eto', check_date) and self._result_cache.contains('rain', check_date):
+                    result[check_date] = (self._result_cache.get('eto', check_date),
+                                          self._result_cache.get('rain', check_date))
+
+        failed = [(check_date, error) for check_date, error in failed if check_date not in result]
+        if failed:
+            logging.warning('Could not get weather information for %s, using fallbacks:\n%s',
+                            ', '.join(str(check_date) for check_date, _ in failed), failed[-1][1])
+        return result
+
+    def _calc_eto_and_rain(self, data, check_dates):
+        """Calculates the ETo and rain of the given dates using NumPy, get_eto uses this as well if NumPy is available.
+        Returns a list of ETo values and a list of rain values."""
+        forecast_index = self._forecast_index(data)
+        days = len(check_dates)
+
+        hours = []
+        indices = []
+        local_hours = []
+        fractional_days = []
+        for index, check_date in enumerate(check_dates):
+            for x in forecast_index['hourly'].get(check_date, []):
+                hour_datetime = datetime.datetime.fromtimestamp(x['dt'])
+                year_datetime = datetime.datetime(hour_datetime.year, 1, 1)
+                hours.append(x)
+                indices.append(index)
+                local_hours.append(hour_datetime.hour)
+                fractional_days.append((360/365.25)*(hour_datetime - year_datetime).total_seconds() / 3600 / 24)
+        indices = numpy.array(indices, dtype=int)
+
+        def column(name):
+            return (numpy.array([x.get(name, 0.0) for x in hours], dtype=float),
+                    numpy.array([name in x for x in hours], dtype=bool))
+
+        def day_sum(values):
+            return numpy.bincount(indices, weights=values, minlength=days)
+
+        total_solar_radiation = numpy.zeros(days)
+        total_clear_sky_isolation = numpy.zeros(days)
+        coverage, has_coverage = column('cloudCover')
+        if has_coverage.any():
+            solar_radiation, clear_sky_isolation = self._calc_radiation(coverage, numpy.array(fractional_days),
+                                                                        numpy.array(local_hours), numpy)
+
+            total_solar_radiation = day_sum(numpy.where(has_coverage, solar_radiation, 0))
+            total_clear_sky_isolation = day_sum(numpy.where(has_coverage, clear_sky_isolation, 0))
+
+        temperature, has_temperature = column('temperature')
+        temp_avg = day_sum(numpy.where(has_temperature, temperature, 0)) / numpy.maximum(1, day_sum(None))
+
+        humidity, has_humidity = column('humidity')
+        humid_min = numpy.full(days, 100.0)
+        humid_max = numpy.zeros(days)
+        numpy.minimum.at(humid_min, indices[has_humidity], humidity[has_humidity] * 100)
+        numpy.maximum.at(humid_max, indices[has_humidity], humidity[has_humidity] * 100)
+
+        precip_intensity, has_precip_intensity = column('precipIntensity')
+        precip_probability, has_precip_probability = column('precipProbability')
+        rain = day_sum(numpy.where(has_precip_intensity & has_precip_probability,
+                                   precip_intensity * precip_probability, 0))
+
+        daily_data = [forecast_index['daily'].get(check_date, {}) for check_date in check_dates]
+
+        # m/s at 2m above ground
+        wind_speed = numpy.array([x.get('windSpeed', 0.0) for x in daily_data], dtype=float) * 0.748
+        pressure = numpy.array([x.get('pressure', 1000) for x in daily_data], dtype=float) / 10 # kPa
+        temp_min = numpy.array([x.get('temperatureMin', 20) for x in daily_data], dtype=float) # degrees C
+        temp_max = numpy.array([x.get('temperatureMax', 20) for x in daily_data], dtype=float) # degrees C
+
+        eto = self._calc_eto(numpy, total_solar_radiation, total_clear_sky_isolation, temp_avg, humid_min, humid_max,
+                             wind_speed, pressure, temp_min, temp_max)
+
+        return eto.tolist(), rain.tolist()
+
     @_cache('rain')
     def get_rain(self, check_date):
         if isinstance(check_date, datetime.datetime):
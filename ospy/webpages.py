@@ -4,17 +4,24 @@
 # System imports
 import os
 import datetime
+import hashlib
+import io
 import json
+import logging
+import marshal
+import time
 import web
-from threading import Timer
+from threading import Lock, Timer
 
 # Local imports
 from ospy.helpers import test_password, template_globals, check_login, save_to_options, \
-    password_hash, password_salt, get_input, get_help_files, get_help_file
+    password_hash, password_salt, get_input, get_help_files, get_help_file, versioned_response, run_filters
 from ospy.inputs import inputs
 from ospy.log import log
 from ospy.options import options
 from ospy.options import rain_blocks
+from ospy.options import state_version
+from ospy.options import status_version
 from ospy.programs import programs
 from ospy.programs import ProgramType
 from ospy.runonce import run_once
@@ -36,35 +43,108 @@ signin_form = form.Form(
 )
 
 
+try:
+    from importlib.util import MAGIC_NUMBER as _PYTHON_MAGIC
+except ImportError:
+    import imp
+    _PYTHON_MAGIC = imp.get_magic()
+
+TEMPLATE_CACHE_DIR = './ospy/data/templates'
+_template_cache_lock = Lock()
+
+
+class _CachedTemplate(web.template.Template):
+    """Template that stores its compiled code in TEMPLATE_CACHE_DIR.
+    The code is only compiled again if the template, Python or web.py has changed."""
+
+    def compile_template(self, template_string, filename):
+        digest = hashlib.sha1(template_string.encode('utf-8') + _PYTHON_MAGIC +
+                              web.__version__.encode('ascii')).hexdigest().encode('ascii')
+        path = os.path.join(TEMPLATE_CACHE_DIR, filename.replace('/', '_').replace(os.sep, '_') + '.code')
+
+        try:
+            with open(path, 'rb') as cache_file:
+                if cache_file.readline().rstrip(b'\n') == digest:
+                    return marshal.loads(cache_file.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass  # Compile it again
+
+        code = web.template.Template.compile_template(self, template_string, filename)
+        try:
+            with _template_cache_lock:
+                if not os.path.isdir(TEMPLATE_CACHE_DIR):
+                    os.makedirs(TEMPLATE_CACHE_DIR)
+                with open(path, 'wb') as cache_file:
+                    cache_file.write(digest + b'\n')
+                    cache_file.write(marshal.dumps(code))
+        except (IOError, OSError):
+            logging.warning('Could not cache the compiled template %s.', filename)
+        return code
+
+
 class InstantCacheRender(web.template.render):
-    '''This class immediately starts caching all templates in the given location.'''
+    '''This class immediately loads all templates in the given location, using the cached compiled code.'''
     def __init__(self, loc='templates', cache=None, base=None, limit=None, exclude=None, **keywords):
         web.template.render.__init__(self, loc, cache, base, **keywords)
 
         self._limit = limit
         self._exclude = exclude
 
-        from threading import Thread
-        t = Thread(target=self._fill_cache)
-        t.daemon = True
-        t.start()
+        self._fill_cache()
 
     def _fill_cache(self):
-        import time
         if os.path.isdir(self._loc):
             for name in os.listdir(self._loc):
                 if name.endswith('.html') and \
                         (self._limit is None or name[:-5] in self._limit) and \
                         (self._exclude is None or name[:-5] not in self._exclude):
                     self._template(name[:-5])
-                    time.sleep(0.1)
+
+    def _load_template(self, name):
+        kind, path = self._lookup(name)
+        if kind == 'file':
+            with io.open(path, encoding='utf-8') as template_file:
+                return _CachedTemplate(template_file.read(), filename=path, **self._keywords)
+        return web.template.render._load_template(self, name)
+
+
+class _FragmentCache(object):
+    """Renders the templates of the given render as page fragments.
+    The results are kept until the state version changes, so fragments should only depend on the state."""
+
+    def __init__(self, render):
+        self._render = render
+        self._lock = Lock()
+        self._version = None
+        self._fragments = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def fragment():
+            version = state_version.value
+            with self._lock:
+                if self._version != version:
+                    self._version = version
+                    self._fragments.clear()
+                result = self._fragments.get(name)
+            if result is None:
+                result = web.safeunicode(getattr(self._render, name)())
+                with self._lock:
+                    if self._version == version:
+                        self._fragments[name] = result
+            return result
+        return fragment
 
 
 class WebPage(object):
     base_render = InstantCacheRender(os.path.join('ospy', 'templates'),
                                      globals=template_globals(), limit=['base']).base
+    fragment_render = InstantCacheRender(os.path.join('ospy', 'templates', 'fragments'), globals=template_globals())
     core_render = InstantCacheRender(os.path.join('ospy', 'templates'),
-                                     globals=template_globals(), exclude=['base'], base=base_render)
+                                     globals=dict(template_globals(), fragments=_FragmentCache(fragment_render)),
+                                     exclude=['base'], base=base_render)
 
     def __init__(self):
         cls = self.__class__
@@ -197,10 +277,8 @@ class action_page(ProtectedPage):
 
             else:  # If status is off
                 stations.deactivate(sid)
-                active = log.active_runs()
-                for interval in active:
-                    if interval['station'] == sid:
-                        log.finish_run(interval)
+                for interval in log.active_runs_for_station(sid):
+                    log.finish_run(interval)
 
         self._redirect_back()
 
@@ -416,27 +494,33 @@ class log_page(ProtectedPage):
             raise web.seeother('/log')
 
         if 'csv' in qdict:
-            events = log.finished_runs() + log.active_runs()
-            data = "Date, Start Time, Zone, Duration, Program\n"
-            for interval in events:
-                # return only records that are visible on this day:
-                duration = (interval['end'] - interval['start']).total_seconds()
-                minutes, seconds = divmod(duration, 60)
-
-                data += ', '.join([
-                    interval['start'].strftime("%Y-%m-%d"),
-                    interval['start'].strftime("%H:%M:%S"),
-                    str(interval['station']),
-                    "%02d:%02d" % (minutes, seconds),
-                    interval['program_name']
-                ]) + '\n'
-
+            # Optionally filtered using start, end, station and after (see run_filters)
+            try:
+                runs = log.iter_runs(**run_filters(qdict))
+            except ValueError as e:
+                raise web.badrequest('Invalid filter: %s' % e)
             web.header('Content-Type', 'text/csv')
             web.header('Content-Disposition', 'attachment; filename="log.csv"')
-            return data
+            return self._csv(runs)
 
         return self.core_render.log()
 
+    @staticmethod
+    def _csv(runs):
+        """Yields the lines of the CSV file, to send them while they are created."""
+        yield "Date, Start Time, Zone, Duration, Program\n"
+        for interval in runs:
+            duration = (interval['end'] - interval['start']).total_seconds()
+            minutes, seconds = divmod(duration, 60)
+
+            yield ', '.join([
+                interval['start'].strftime("%Y-%m-%d"),
+                interval['start'].strftime("%H:%M:%S"),
+                str(interval['station']),
+                "%02d:%02d" % (minutes, seconds),
+                interval['program_name']
+            ]) + '\n'
+
 
 class options_page(ProtectedPage):
     """Open the options page for viewing and editing."""
@@ -487,28 +571,29 @@ class stations_page(ProtectedPage):
         qdict = web.input()
 
         recalc = False
-        for s in range(0, stations.count()):
-            stations[s].name = qdict["%d_name" % s]
-            stations[s].usage = float(qdict.get("%d_usage" % s, 1.0))
-            stations[s].precipitation = float(qdict.get("%d_precipitation" % s, 10.0))
-            stations[s].capacity = float(qdict.get("%d_capacity" % s, 10.0))
-            stations[s].eto_factor = float(qdict.get("%d_eto_factor" % s, 1.0))
-            stations[s].enabled = True if qdict.get("%d_enabled" % s, 'off') == 'on' else False
-            stations[s].ignore_rain = True if qdict.get("%d_ignore_rain" % s, 'off') == 'on' else False
-            if stations.master is not None or options.master_relay:
-                stations[s].activate_master = True if qdict.get("%d_activate_master" % s, 'off') == 'on' else False
-
-            balance_adjust = float(qdict.get("%d_balance_adjust" % s, 0.0))
-            if balance_adjust != 0.0:
-                calc_day = datetime.datetime.now().date() - datetime.timedelta(days=1)
-                stations[s].balance[calc_day]['intervals'].append({
-                                'program': -1,
-                                'program_name': 'Balance adjustment',
-                                'done': True,
-                                'irrigation': balance_adjust
-                            })
-                stations[s].balance[calc_day]['total'] += balance_adjust
-                recalc = True
+        with stations.edit():
+            for s in range(0, stations.count()):
+                stations[s].name = qdict["%d_name" % s]
+                stations[s].usage = float(qdict.get("%d_usage" % s, 1.0))
+                stations[s].precipitation = float(qdict.get("%d_precipitation" % s, 10.0))
+                stations[s].capacity = float(qdict.get("%d_capacity" % s, 10.0))
+                stations[s].eto_factor = float(qdict.get("%d_eto_factor" % s, 1.0))
+                stations[s].enabled = True if qdict.get("%d_enabled" % s, 'off') == 'on' else False
+                stations[s].ignore_rain = True if qdict.get("%d_ignore_rain" % s, 'off') == 'on' else False
+                if stations.master is not None or options.master_relay:
+                    stations[s].activate_master = True if qdict.get("%d_activate_master" % s, 'off') == 'on' else False
+
+                balance_adjust = float(qdict.get("%d_balance_adjust" % s, 0.0))
+                if balance_adjust != 0.0:
+                    calc_day = datetime.datetime.now().date() - datetime.timedelta(days=1)
+                    stations[s].balance[calc_day]['intervals'].append({
+                                    'program': -1,
+                                    'program_name': 'Balance adjustment',
+                                    'done': True,
+                                    'irrigation': balance_adjust
+                                })
+                    stations[s].balance[calc_day]['total'] += balance_adjust
+                    recalc = True
 
         if recalc:
             Timer(0.1, programs.calculate_balances).start()
@@ -532,50 +617,116 @@ class help_page(ProtectedPage):
 ################################################################################
 # APIs                                                                         #
 ################################################################################
+def station_status():
+    """Returns the status of all enabled stations and the master station, as shown on the home page."""
+    statuslist = []
+    for station in stations.get():
+        if station.enabled or station.is_master:
+            status = {
+                'station': station.index,
+                'status': 'on' if station.active else 'off',
+                'reason': 'master' if station.is_master else '',
+                'master': 1 if station.is_master else 0,
+                'programName': '',
+                'remaining': 0}
+
+            if not station.is_master:
+                if options.manual_mode:
+                    status['programName'] = 'Manual Mode'
+                else:
+                    if station.active:
+                        for interval in log.active_runs_for_station(station.index):
+                            if not interval['blocked']:
+                                status['programName'] = interval['program_name']
+
+                                status['reason'] = 'program'
+                                status['remaining'] = max(0, (interval['end'] -
+                                                              datetime.datetime.now()).total_seconds())
+                    elif not options.scheduler_enabled:
+                        status['reason'] = 'system_off'
+                    elif not station.ignore_rain and inputs.rain_sensed():
+                        status['reason'] = 'rain_sensed'
+                    elif not station.ignore_rain and rain_blocks.seconds_left():
+                        status['reason'] = 'rain_delay'
+
+            statuslist.append(status)
+    return statuslist
+
+
+class _StatusBroadcast(object):
+    """Shares the serialized station status between all clients following it.
+    The status is only determined once for every change of the status version."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._version = None
+        self._data = None
+
+    def get(self):
+        with self._lock:
+            version = status_version.value
+            if version != self._version:
+                self._data = json.dumps(station_status())
+                self._version = version
+            return self._version, self._data
+
+status_broadcast = _StatusBroadcast()
+
+
 class api_status_json(ProtectedPage):
     """Simple Status API"""
 
     def GET(self):
-        statuslist = []
-        for station in stations.get():
-            if station.enabled or station.is_master:
-                status = {
-                    'station': station.index,
-                    'status': 'on' if station.active else 'off',
-                    'reason': 'master' if station.is_master else '',
-                    'master': 1 if station.is_master else 0,
-                    'programName': '',
-                    'remaining': 0}
-
-                if not station.is_master:
-                    if options.manual_mode:
-                        status['programName'] = 'Manual Mode'
+        web.header('Content-Type', 'application/json')
+        return json.dumps(station_status())
+
+
+class api_status_events(ProtectedPage):
+    """Status API pushing the status using server-sent events whenever it changes.
+    Every client keeps one server thread busy, so only a quarter of the server threads can be used for streams
+    (other clients get a 503 response and should poll /status.json instead). A stream is ended after
+    DURATION seconds, after which the client reconnects automatically."""
+    DURATION = 30
+    KEEP_ALIVE = 5  # Also determines how fast closed connections are noticed
+
+    _lock = Lock()
+    _streams = 0
+
+    def GET(self):
+        cls = api_status_events
+        with cls._lock:
+            if cls._streams >= options.web_threads // 4:
+                raise web.HTTPError('503 Service Unavailable', {'Content-Type': 'text/plain'}, 'Too many status streams')
+            cls._streams += 1
+
+        web.header('Content-Type', 'text/event-stream')
+        web.header('Cache-Control', 'no-cache')
+
+        def events():
+            try:
+                end_time = time.time() + self.DURATION
+                version = status_version.value
+                data = json.dumps(station_status())  # The shared status might have been determined a while ago
+                yield 'retry: 1000\ndata: %s\n\n' % data
+                while time.time() < end_time:
+                    if status_version.wait(version, min(self.KEEP_ALIVE, end_time - time.time())) == version:
+                        yield ': keep-alive\n\n'
                     else:
-                        if station.active:
-                            active = log.active_runs()
-                            for interval in active:
-                                if not interval['blocked'] and interval['station'] == station.index:
-                                    status['programName'] = interval['program_name']
-
-                                    status['reason'] = 'program'
-                                    status['remaining'] = max(0, (interval['end'] -
-                                                                  datetime.datetime.now()).total_seconds())
-                        elif not options.scheduler_enabled:
-                            status['reason'] = 'system_off'
-                        elif not station.ignore_rain and inputs.rain_sensed():
-                            status['reason'] = 'rain_sensed'
-                        elif not station.ignore_rain and rain_blocks.seconds_left():
-                            status['reason'] = 'rain_delay'
-
-                statuslist.append(status)
+                        version, new_data = status_broadcast.get()
+                        if new_data != data:
+                            data = new_data
+                            yield 'data: %s\n\n' % data
+            finally:
+                with cls._lock:
+                    cls._streams -= 1
 
-        web.header('Content-Type', 'application/json')
-        return json.dumps(statuslist)
+        return events()
 
 
 class api_log_json(ProtectedPage):
     """Simple Log API"""
 
+    @versioned_response(max_age=60)  # The predicted schedule moves along with the time
     def GET(self):
         qdict = web.input()
         data = []
@@ -617,6 +768,7 @@ class api_log_json(ProtectedPage):
 class api_balance_json(ProtectedPage):
     """Balance API"""
 
+    @versioned_response()
     def GET(self):
         statuslist = []
         epoch = datetime.date(1970, 1, 1)
@@ -227,6 +227,9 @@ if __name__ == '__main__':
                                 'https://github.com/Zopieux/cmarkgfm/archive/master.zip', 'cmarkgfm-master',
                                 [[sys.executable, 'setup.py', 'install']])
 
+            # Optional, speeds up the weather calculations:
+            install_package('numpy', None, 'python-numpy' if is_python2() else 'python3-numpy', 'numpy')
+
         install_service()
 
         check_password()
@@ -95,7 +95,7 @@ function scheduleMarkerMouseout() {
     jQuery(this).children(".showDetails").remove();
 }
 
-function updateStatus(status) {
+function updateStatus(status, streaming) {
     var display, updateInterval = 30000;
     for (var s=0; s<status.length; s++) {
         var station = status[s];
@@ -137,13 +137,45 @@ function updateStatus(status) {
             .removeClass()
             .addClass(classes);
     }
-    setTimeout(statusTimer, updateInterval);
+    if (!streaming) {
+        setTimeout(statusTimer, updateInterval);
+    }
 }
 
 function statusTimer() {
     jQuery.getJSON("/status.json", updateStatus)
 }
 
+function followStatus() {
+    // The server pushes the status on every change, the remaining times are counted down here:
+    if (window.EventSource) {
+        var status = null, received = 0;
+        var source = new EventSource("/status.events");
+        source.onmessage = function(event) {
+            status = JSON.parse(event.data);
+            received = Date.now();
+            updateStatus(status, true);
+        };
+        var countdown = setInterval(function() {
+            if (status != null) {
+                var elapsed = (Date.now() - received) / 1000;
+                updateStatus(jQuery.map(status, function(station) {
+                    return jQuery.extend({}, station, {remaining: Math.max(0, station.remaining - elapsed)});
+                }), true);
+            }
+        }, 1000);
+        source.onerror = function() {
+            // The server refuses streams if too many clients follow the status, poll instead:
+            if (source.readyState == EventSource.CLOSED) {
+                clearInterval(countdown);
+                statusTimer();
+            }
+        };
+    } else {
+        statusTimer();
+    }
+}
+
 function water_level_prompt(current){
     if (current != 1.0) {
         var w = 100;
@@ -322,7 +354,7 @@ jQuery(document).ready(function(){
         });
     } else {
         displayProgram()
-        setTimeout(statusTimer, 1000);
+        setTimeout(followStatus, 1000);
 
         jQuery(".button#pPrev").click(function() {
             displayScheduleDate.setDate(displayScheduleDate.getDate() - 1);